@@ -0,0 +1,32 @@
+// Boot allégé (log.www.Colis.get_boot) : revalidé par ETag quand l'application
+// revient au premier plan ; une réponse 304 est servie depuis le cache HTTP du navigateur
+
+const BOOT_METHOD = '/api/method/log.www.Colis.get_boot';
+
+export const refreshBoot = async () => {
+	const response = await fetch(BOOT_METHOD, {
+		credentials: 'include',
+		// Revalidation systématique (If-None-Match) auprès du serveur
+		cache: 'no-cache',
+		headers: { Accept: 'application/json' },
+	});
+	if (!response.ok) {
+		return;
+	}
+
+	const boot = await response.json();
+	// @ts-ignore
+	window.frappe = { ...window.frappe, boot };
+	// @ts-ignore
+	window.csrf_token = boot.csrf_token;
+};
+
+// Un téléphone laisse l'application ouverte toute la journée : la session ou
+// le jeton CSRF ont pu changer pendant qu'elle était en arrière-plan
+export const watchBoot = () => {
+	document.addEventListener('visibilitychange', () => {
+		if (document.visibilityState === 'visible') {
+			refreshBoot().catch(() => undefined);
+		}
+	});
+};
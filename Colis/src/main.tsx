@@ -2,6 +2,9 @@ import { StrictMode } from 'react'
 import { createRoot } from 'react-dom/client'
 import './index.css'
 import App from './App.tsx'
+import { watchBoot } from './lib/boot'
+
+watchBoot()
 
 createRoot(document.getElementById('root')!).render(
   <StrictMode>
@@ -1,5 +1,6 @@
 import { Flex, Box, Heading, Text, Badge, Card, Table, Button, Separator, TextField } from '@radix-ui/themes';
 import { useState, useRef } from 'react';
+import { useFrappeEventListener } from 'frappe-react-sdk';
 import { CalendarIcon, PersonIcon, BoxIcon, CheckIcon, CrossCircledIcon, Pencil1Icon, CameraIcon } from '@radix-ui/react-icons';
 
 interface Article {
@@ -28,6 +29,20 @@ interface ColisData {
   commentaire_livreur?: string;
 }
 
+interface ColisChangesEvent {
+  bl: string;
+  colis: {
+    name: string;
+    status?: string;
+    articles?: {
+      name: string;
+      statut_article: string;
+      quantite_livree: number;
+      quantite_restante: number;
+    }[];
+  }[];
+}
+
 const ColisDetails = () => {
   // Données de test
   const [colisData, setColisData] = useState<ColisData>({
@@ -96,6 +111,22 @@ const ColisDetails = () => {
     }
   };
 
+  // Changements diffusés en temps réel par le serveur (diff compact) : statut
+  // du colis et champs de livraison des seuls articles modifiés
+  useFrappeEventListener('log_colis_changes', (data: ColisChangesEvent) => {
+    const change = data.colis.find((c) => c.name === colisData.id);
+    if (!change) return;
+
+    setColisData(prevData => ({
+      ...prevData,
+      status: change.status ?? prevData.status,
+      articles: prevData.articles.map((article) => {
+        const articleChange = change.articles?.find((a) => a.name === article.id);
+        return articleChange ? { ...article, ...articleChange, id: article.id } : article;
+      })
+    }));
+  });
+
   // État pour gérer l'édition des quantités
   const [editingArticle, setEditingArticle] = useState<string | null>(null);
   const [tempQuantity, setTempQuantity] = useState<number>(0);
@@ -1,11 +1,53 @@
+import fs from 'fs';
 import path from 'path';
+import zlib from 'zlib';
+import { promisify } from 'util';
 import { defineConfig } from 'vite';
+import type { Plugin } from 'vite';
 import react from '@vitejs/plugin-react'
 import proxyOptions from './proxyOptions';
 
+const gzip = promisify(zlib.gzip);
+const brotliCompress = promisify(zlib.brotliCompress);
+
+// Fichiers servis précompressés (gzip_static / brotli_static côté nginx)
+const COMPRESSIBLE = /\.(js|mjs|css|html|svg|json|txt)$/;
+const MIN_COMPRESS_SIZE = 1024;
+
+// Écrit une variante .gz et .br de chaque fichier du bundle, à côté de l'original
+function precompress(): Plugin {
+	return {
+		name: 'log-precompress',
+		apply: 'build',
+		async writeBundle(options, bundle) {
+			const outDir = options.dir ?? path.dirname(options.file ?? '');
+			await Promise.all(Object.keys(bundle).filter((fileName) => COMPRESSIBLE.test(fileName)).map(async (fileName) => {
+				const filePath = path.join(outDir, fileName);
+				const content = await fs.promises.readFile(filePath);
+				if (content.length < MIN_COMPRESS_SIZE) {
+					return;
+				}
+				const [gz, br] = await Promise.all([
+					gzip(content, { level: zlib.constants.Z_BEST_COMPRESSION }),
+					brotliCompress(content, {
+						params: {
+							[zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+							[zlib.constants.BROTLI_PARAM_SIZE_HINT]: content.length,
+						},
+					}),
+				]);
+				await Promise.all([
+					fs.promises.writeFile(`${filePath}.gz`, gz),
+					fs.promises.writeFile(`${filePath}.br`, br),
+				]);
+			}));
+		},
+	};
+}
+
 // https://vitejs.dev/config/
 export default defineConfig({
-	plugins: [react()],
+	plugins: [react(), precompress()],
 	server: {
 		port: 8080,
 		host: '0.0.0.0',
@@ -20,5 +62,15 @@ export default defineConfig({
 		outDir: '../log/public/Colis',
 		emptyOutDir: true,
 		target: 'es2015',
+		// .vite/manifest.json : lu par /Colis pour les en-têtes de préchargement
+		manifest: true,
+		rollupOptions: {
+			output: {
+				// Noms adressés par le contenu : cache immuable sous /assets/log/Colis/assets/
+				entryFileNames: 'assets/[name]-[hash].js',
+				chunkFileNames: 'assets/[name]-[hash].js',
+				assetFileNames: 'assets/[name]-[hash][extname]',
+			},
+		},
 	},
 });
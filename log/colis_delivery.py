@@ -0,0 +1,261 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Livraison des articles d'un colis.
+
+Chaque opération verrouille la ligne Colis et ses Articles Colis
+(SELECT ... FOR UPDATE), applique les quantités, le statut de l'article
+et le statut global du colis par des UPDATE directs, le tout dans la
+transaction de la requête : ni sauvegarde complète du colis, ni rechargement,
+ni commit explicite.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import now_datetime
+
+from log.colis_info import clear_colis_info_cache
+from log.colis_realtime import publish_colis_changes
+from log.delivery_note_sync import schedule_delivery_note_sync
+from log.log.doctype.articles_colis.articles_colis import (
+	compute_quantite_restante,
+	compute_statut_article,
+)
+
+ARTICLE_FIELDS = ("quantite_totale", "quantite_livree", "quantite_restante", "statut_article")
+DELIVERABLE_STATUSES = ("En attente", "Partiellement livré")
+
+
+def compute_global_status(article_statuses, current_status=None):
+	"""Calcule le statut global d'un colis à partir des statuts de ses articles
+
+	Args:
+		article_statuses (list): Les statuts des articles
+		current_status (str): Le statut actuel du colis, conservé si rien ne le remplace
+
+	Returns:
+		str: Le statut global du colis
+	"""
+	article_statuses = [status for status in article_statuses if status]
+	if not article_statuses:
+		return current_status
+
+	if all(status == "Livré" for status in article_statuses):
+		return "Livré"
+	if all(status == "En attente" for status in article_statuses):
+		# Garder le statut actuel si tous les articles sont en attente
+		return current_status
+	if any(status == "Partiellement livré" for status in article_statuses) or (
+		any(status == "Livré" for status in article_statuses)
+		and any(status in ["En attente", "Partiellement livré"] for status in article_statuses)
+	):
+		return "Partiellement Livré"
+	if all(status == "Non livré" for status in article_statuses):
+		return "Non Livré"
+	return current_status
+
+
+def lock_colis(colis_name):
+	"""Verrouille un colis et ses articles pour la durée de la transaction
+
+	Returns:
+		tuple: (colis, articles) sous forme de dicts
+	"""
+	colis = frappe.db.sql(
+		"""
+		SELECT name, status, bl
+		FROM `tabColis`
+		WHERE name = %s
+		FOR UPDATE
+		""",
+		(colis_name,),
+		as_dict=True,
+	)
+	if not colis:
+		frappe.throw(_("Colis {0} introuvable").format(colis_name), frappe.DoesNotExistError)
+
+	articles = frappe.db.sql(
+		"""
+		SELECT name, article, quantite_totale, quantite_livree, quantite_restante, statut_article
+		FROM `tabArticles Colis`
+		WHERE parent = %s AND parenttype = 'Colis'
+		ORDER BY idx
+		FOR UPDATE
+		""",
+		(colis_name,),
+		as_dict=True,
+	)
+	return colis[0], articles
+
+
+def deliver_quantity(colis_name, article_name, quantity):
+	"""Livre une quantité spécifique d'un article"""
+	if quantity <= 0:
+		frappe.throw(_("La quantité à livrer doit être positive"))
+
+	def apply(row):
+		if (row.quantite_livree or 0) + quantity > (row.quantite_totale or 0):
+			frappe.throw(
+				_("Impossible de livrer {0}. Quantité restante: {1}").format(quantity, row.quantite_restante)
+			)
+		return _delivered_values(row, (row.quantite_livree or 0) + quantity), _(
+			"Livraison de {0} unités effectuée"
+		).format(quantity)
+
+	return _apply_article_change(colis_name, article_name, apply)
+
+
+def deliver_remaining(colis_name, article_name):
+	"""Livre toute la quantité restante d'un article"""
+
+	def apply(row):
+		remaining = compute_quantite_restante(row.quantite_totale, row.quantite_livree)
+		if remaining <= 0:
+			frappe.throw(_("Aucune quantité restante à livrer"))
+		return _delivered_values(row, row.quantite_totale), _("Livraison de {0} unités effectuée").format(
+			remaining
+		)
+
+	return _apply_article_change(colis_name, article_name, apply)
+
+
+def mark_undeliverable(colis_name, article_name, reason=""):
+	"""Marque un article comme non livrable"""
+
+	def apply(row):
+		return {"statut_article": "Non livré"}, _("Article marqué comme non livrable. Raison: {0}").format(
+			reason
+		)
+
+	return _apply_article_change(colis_name, article_name, apply)
+
+
+def deliver_all(colis_name):
+	"""Livre la quantité restante de tous les articles livrables d'un colis
+
+	Les lignes livrables sont mises à jour par un seul UPDATE ensembliste,
+	la date de livraison est la même pour toutes et le statut du colis
+	n'est recalculé qu'une fois.
+
+	Returns:
+		dict: Résultat global et détail par article (`articles`)
+	"""
+	colis, articles = lock_colis(colis_name)
+
+	now = now_datetime()
+	results = []
+	delivered = []
+	for row in articles:
+		remaining = compute_quantite_restante(row.quantite_totale, row.quantite_livree)
+		if remaining <= 0:
+			results.append(
+				{"name": row.name, "success": False, "message": _("Aucune quantité restante à livrer")}
+			)
+		elif row.statut_article not in DELIVERABLE_STATUSES:
+			results.append(
+				{
+					"name": row.name,
+					"success": False,
+					"message": _("Article au statut {0} non livrable").format(row.statut_article),
+				}
+			)
+		else:
+			delivered.append(row.name)
+			row.update(_delivered_values(row, row.quantite_totale, now))
+			results.append(
+				{
+					"name": row.name,
+					"success": True,
+					"message": _("Livraison de {0} unités effectuée").format(remaining),
+				}
+			)
+
+	for result, row in zip(results, articles, strict=True):
+		result["article_data"] = {field: row.get(field) for field in ARTICLE_FIELDS}
+
+	if delivered:
+		frappe.db.sql(
+			"""
+			UPDATE `tabArticles Colis`
+			SET quantite_livree = quantite_totale,
+				quantite_restante = 0,
+				statut_article = 'Livré',
+				date_derniere_livraison = %(now)s,
+				modified = %(now)s,
+				modified_by = %(user)s
+			WHERE parent = %(colis)s AND parenttype = 'Colis' AND name IN %(names)s
+			""",
+			{"now": now, "user": frappe.session.user, "colis": colis.name, "names": tuple(delivered)},
+		)
+		new_status = update_colis_status(colis, articles, [row for row in articles if row.name in delivered])
+	else:
+		new_status = colis.status
+
+	return {
+		"success": bool(delivered),
+		"message": _("{0} article(s) livré(s) avec succès").format(len(delivered))
+		if delivered
+		else _("Aucun article à livrer"),
+		"delivered_count": len(delivered),
+		"colis_status": new_status,
+		"articles": results,
+	}
+
+
+def _delivered_values(row, quantite_livree, now=None):
+	return {
+		"quantite_livree": quantite_livree,
+		"quantite_restante": compute_quantite_restante(row.quantite_totale, quantite_livree),
+		"statut_article": compute_statut_article(row.quantite_totale, quantite_livree),
+		"date_derniere_livraison": now or now_datetime(),
+	}
+
+
+def _apply_article_change(colis_name, article_name, apply):
+	colis, articles = lock_colis(colis_name)
+
+	row = next((article for article in articles if article.name == article_name), None)
+	if not row:
+		frappe.throw(_("Article non trouvé"), frappe.DoesNotExistError)
+
+	values, message = apply(row)
+	frappe.db.set_value("Articles Colis", row.name, values)
+	row.update(values)
+
+	new_status = update_colis_status(colis, articles, [row])
+
+	article_data = {field: row.get(field) for field in ARTICLE_FIELDS}
+	return {
+		"success": True,
+		"message": message,
+		**article_data,
+		"article_data": article_data,
+		"colis_status": new_status,
+	}
+
+
+def update_colis_status(colis, articles, changed_articles=()):
+	"""Recalcule le statut global et met à jour le colis (statut et date de modification)
+
+	Args:
+		colis (dict): Le colis verrouillé (name, status, bl)
+		articles (list): Ses articles, avec les valeurs à jour
+		changed_articles (list): Les articles modifiés, diffusés en temps réel
+
+	Returns:
+		str: Le nouveau statut du colis
+	"""
+	new_status = compute_global_status([a.statut_article for a in articles], colis.status)
+	frappe.db.set_value("Colis", colis.name, "status", new_status)
+
+	on_colis_delivery_change(colis, new_status, changed_articles)
+	return new_status
+
+
+def on_colis_delivery_change(colis, status=None, changed_articles=()):
+	"""Propage une modification des livraisons d'un colis (vue publique, synchronisation de la DN, temps réel)"""
+	clear_colis_info_cache(colis.name)
+	schedule_delivery_note_sync(colis.bl)
+	publish_colis_changes(
+		[{"name": colis.name, "bl": colis.bl, "status": status or colis.status, "articles": changed_articles}]
+	)
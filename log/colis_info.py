@@ -0,0 +1,85 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Vue publique de suivi d'un colis (scan du QR code), mise en cache dans Redis.
+
+L'entrée est invalidée par les hooks de mise à jour de Colis / Articles Colis
+et par les opérations qui écrivent directement en base.
+"""
+
+import frappe
+
+from log.utils import record_invalidation
+
+CACHE_KEY = "log:colis_info"
+CACHE_TTL = 6 * 60 * 60
+
+
+def get_cached_colis_info(colis_name):
+	"""Retourne les informations publiques d'un colis, depuis le cache si possible"""
+	data = frappe.cache.get_value(_cache_key(colis_name))
+	if data is not None:
+		return data
+
+	data = build_colis_info(colis_name)
+	frappe.cache.set_value(_cache_key(colis_name), data, expires_in_sec=CACHE_TTL)
+	return data
+
+
+def build_colis_info(colis_name):
+	"""Construit les informations publiques d'un colis (noms d'articles résolus en une requête)"""
+	colis = frappe.get_doc("Colis", colis_name)
+
+	item_codes = list({article.article for article in colis.articles if article.article})
+	item_names = (
+		dict(
+			frappe.get_all(
+				"Item", filters={"name": ["in", item_codes]}, fields=["name", "item_name"], as_list=True
+			)
+		)
+		if item_codes
+		else {}
+	)
+
+	return {
+		"name": colis.name,
+		"status": colis.status,
+		"client": colis.client,
+		"bl": colis.bl,
+		"date_creation": colis.creation,
+		"modified": colis.modified,
+		"articles": [
+			{
+				"name": article.name,
+				"article": article.article,
+				"item_name": item_names.get(article.article),
+				"quantite_totale": article.quantite_totale,
+				"quantite_livree": article.quantite_livree,
+				"quantite_restante": article.quantite_restante,
+				"statut_article": article.statut_article,
+			}
+			for article in colis.articles
+		],
+	}
+
+
+def clear_colis_info_cache(colis_names):
+	"""Invalide la vue publique d'un ou plusieurs colis
+
+	L'invalidation est répétée après le commit pour écarter une entrée
+	reconstruite entre-temps à partir de données non encore validées.
+	"""
+	if isinstance(colis_names, str):
+		colis_names = [colis_names]
+
+	keys = [_cache_key(colis_name) for colis_name in colis_names]
+	if not keys:
+		return
+
+	frappe.cache.delete_value(keys)
+	frappe.db.after_commit.add(lambda: frappe.cache.delete_value(keys))
+	record_invalidation("colis_info", len(keys))
+
+
+def _cache_key(colis_name):
+	return f"{CACHE_KEY}:{colis_name}"
@@ -0,0 +1,90 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Diffusion en temps réel des changements de colis.
+
+Chaque changement (statut, livraison d'articles) est publié après le commit
+sous forme d'un diff compact : le statut du colis et les seuls champs de
+livraison des articles modifiés. Les événements sont regroupés par bon de
+livraison et envoyés dans la room du Delivery Note (formulaire du
+répartiteur) et dans celle de l'utilisateur livreur de la tournée.
+"""
+
+import frappe
+
+EVENT = "log_colis_changes"
+ARTICLE_EVENT_FIELDS = ("name", "statut_article", "quantite_livree", "quantite_restante")
+
+
+def publish_colis_changes(changes):
+	"""Publie après le commit les changements de plusieurs colis, un événement par bon de livraison
+
+	Args:
+		changes (list): Dicts `name`, `bl`, `status` et, si des articles ont changé, `articles`
+	"""
+	by_delivery_note = {}
+	for change in changes:
+		if change.get("bl"):
+			by_delivery_note.setdefault(change["bl"], []).append(_compact(change))
+
+	if not by_delivery_note:
+		return
+
+	drivers = get_driver_users(list(by_delivery_note))
+	for delivery_note, colis in by_delivery_note.items():
+		payload = {"bl": delivery_note, "colis": colis}
+		frappe.publish_realtime(
+			EVENT, payload, doctype="Delivery Note", docname=delivery_note, after_commit=True
+		)
+		if drivers.get(delivery_note):
+			frappe.publish_realtime(EVENT, payload, user=drivers[delivery_note], after_commit=True)
+
+
+def get_changed_articles(doc):
+	"""Articles d'un colis ajoutés ou dont un champ de livraison a changé depuis le chargement
+
+	Args:
+		doc (Document): Le colis en cours de sauvegarde
+
+	Returns:
+		list: Les lignes Articles Colis modifiées (toutes pour un nouveau colis)
+	"""
+	before = doc.get_doc_before_save()
+	if not before:
+		return list(doc.articles)
+
+	previous = {row.name: row for row in before.articles}
+	return [
+		row
+		for row in doc.articles
+		if row.name not in previous
+		or any(row.get(field) != previous[row.name].get(field) for field in ARTICLE_EVENT_FIELDS)
+	]
+
+
+def get_driver_users(delivery_notes):
+	"""Utilisateur du livreur de chaque bon de livraison, en une requête
+
+	Returns:
+		dict: {bon de livraison: utilisateur}
+	"""
+	return dict(
+		frappe.db.sql(
+			"""
+			SELECT dn.name, l.id_utilisateur
+			FROM `tabDelivery Note` dn
+			INNER JOIN `tabLivreur` l ON l.name = dn.custom_livreur
+			WHERE dn.name IN %s AND l.id_utilisateur IS NOT NULL
+			""",
+			(tuple(delivery_notes),),
+		)
+	)
+
+
+def _compact(change):
+	colis = {"name": change["name"], "status": change.get("status")}
+	if change.get("articles"):
+		colis["articles"] = [
+			{field: article.get(field) for field in ARTICLE_EVENT_FIELDS} for article in change["articles"]
+		]
+	return colis
@@ -5,28 +5,82 @@ from frappe.utils import now_datetime
 from frappe import _
 import time
 
+from log import logger
+from log.utils import enqueue_coalesced, invalidate_documents, record_lock_wait, release_coalesced
+
+def get_delivery_note_quantities(delivery_note_name):
+    """
+    Retourne {item_code: {"qty", "description"}} pour les lignes de la DN,
+    en une seule requête agrégée (sans charger le document complet).
+    """
+    rows = frappe.db.sql("""
+        SELECT item_code, SUM(qty) AS qty, MIN(description) AS description
+        FROM `tabDelivery Note Item`
+        WHERE parent = %s AND parenttype = 'Delivery Note'
+        GROUP BY item_code
+        ORDER BY MIN(idx)
+    """, (delivery_note_name,), as_dict=True)
+    return {
+        r.item_code: {"qty": r.qty or 0, "description": r.description or r.item_code}
+        for r in rows
+    }
+
+def lock_delivery_note(delivery_note_name):
+    """
+    Verrouille la ligne de la DN (SELECT ... FOR UPDATE) jusqu'à la fin de la
+    transaction : la création et la validation des colis d'une même DN sont
+    ainsi sérialisées, celles de DN différentes restent parallèles.
+    Le temps d'attente du verrou est mesuré (voir log.utils.get_lock_wait_stats).
+    """
+    start = time.monotonic()
+    frappe.db.sql("""
+        SELECT name
+        FROM `tabDelivery Note`
+        WHERE name = %s
+        FOR UPDATE
+    """, (delivery_note_name,))
+    wait_ms = (time.monotonic() - start) * 1000
+
+    record_lock_wait("delivery_note", wait_ms)
+    logger.debug("packing", "delivery_note_locked",
+        delivery_note=delivery_note_name, wait_ms=round(wait_ms, 1))
+
+def get_packed_quantities(delivery_note_name, exclude_colis=None, locking_read=False):
+    """
+    Retourne {article: quantité déjà colisée} pour tous les Colis de la DN,
+    calculé en une seule requête agrégée.
+    `exclude_colis` permet d'ignorer un colis (celui en cours de validation).
+    `locking_read` lit la dernière version validée des lignes (et non l'instantané
+    de la transaction) : à utiliser après lock_delivery_note.
+    """
+    conditions = ""
+    values = [delivery_note_name]
+    if exclude_colis:
+        conditions = "AND c.name != %s"
+        values.append(exclude_colis)
+
+    rows = frappe.db.sql(f"""
+        SELECT ac.article, SUM(ac.quantite_totale) AS qty
+        FROM `tabArticles Colis` ac
+        INNER JOIN `tabColis` c ON c.name = ac.parent
+        WHERE c.bl = %s AND ac.parenttype = 'Colis' {conditions}
+        GROUP BY ac.article
+        {"LOCK IN SHARE MODE" if locking_read else ""}
+    """, values, as_dict=True)
+    return {r.article: r.qty or 0 for r in rows}
+
 @frappe.whitelist()
 def can_create_colis(delivery_note_name):
     """
     Retourne True si la DN possède au moins un article dont
     la quantité déjà colisée < quantité DN.
     """
-    dn = frappe.get_doc("Delivery Note", delivery_note_name)
-    dn_qty = {item.item_code: item.qty for item in dn.items}
-
-    # cumul des qtés déjà en Colis
-    noms = [c.name for c in frappe.get_all("Colis",
-        filters={"bl": delivery_note_name}, fields=["name"])]
-    cumul = {}
-    if noms:
-        for r in frappe.get_all("Articles Colis",
-            filters={"parent": ["in", noms]},
-            fields=["article", "quantite_totale"]):
-            cumul[r.article] = cumul.get(r.article, 0) + (r.quantite_totale or 0)
+    dn_qty = get_delivery_note_quantities(delivery_note_name)
+    cumul = get_packed_quantities(delivery_note_name)
 
     # s’il reste au moins une unité d’un article
-    for code, total in dn_qty.items():
-        if total - cumul.get(code, 0) > 0:
+    for code, item_info in dn_qty.items():
+        if item_info["qty"] - cumul.get(code, 0) > 0:
             return True
     return False
 
@@ -49,35 +103,33 @@ def create_colis(delivery_note_name):
     Crée un Colis avec la quantité restante pour chaque article,
     puis met à jour séquence et compteur.
     """
-    dn = frappe.get_doc("Delivery Note", delivery_note_name)
-
-    # 1) Calcul du cumul déjà colisé
-    noms = [c.name for c in frappe.get_all("Colis",
-        filters={"bl": delivery_note_name}, fields=["name"])]
-    cumul = {}
-    if noms:
-        for r in frappe.get_all("Articles Colis",
-            filters={"parent": ["in", noms]},
-            fields=["article", "quantite_totale"]):
-            cumul[r.article] = cumul.get(r.article, 0) + (r.quantite_totale or 0)
+    dn = frappe.db.get_value("Delivery Note", delivery_note_name,
+        ["name", "customer", "customer_name"], as_dict=True)
+    if not dn:
+        frappe.throw(_("Delivery Note {0} introuvable").format(delivery_note_name))
+
+    # 1) Calcul du cumul déjà colisé, sous verrou de la DN
+    lock_delivery_note(delivery_note_name)
+    dn_qty = get_delivery_note_quantities(delivery_note_name)
+    cumul  = get_packed_quantities(delivery_note_name, locking_read=True)
 
     # 2) Création du nouveau Colis
     colis = frappe.new_doc("Colis")
     colis.bl     = dn.name
-    colis.client = dn.customer or dn.get("customer_name")
+    colis.client = dn.customer or dn.customer_name
     colis.date   = now_datetime()
 
-    for item in dn.items:
-        used      = cumul.get(item.item_code, 0)
-        remaining = (item.qty or 0) - used
+    for code, item_info in dn_qty.items():
+        used      = cumul.get(code, 0)
+        remaining = item_info["qty"] - used
         if remaining > 0:
             row = colis.append("articles", {})
-            row.article  = item.item_code
+            row.article  = code
             row.quantite_totale = remaining  # Initialiser quantite_totale
             row.quantite_livree = 0  # Initialiser quantite_livree
             row.quantite_restante = remaining  # Initialiser quantite_restante
             row.statut_article = "En attente"  # Initialiser statut_article
-            row.description = item.get("description")
+            row.description = item_info["description"]
 
     colis.insert(ignore_permissions=True)
 
@@ -86,6 +138,32 @@ def create_colis(delivery_note_name):
 
     return colis.name
 
+def _renumber_colis(delivery_note_name):
+    """
+    Recalcule custom_numero_sequence ("i/N", par ordre de création) de tous
+    les Colis de la DN en un seul UPDATE ensembliste ; seules les lignes dont
+    la valeur change sont écrites. Retourne les noms des colis de la DN.
+    """
+    names = frappe.db.sql_list("""
+        SELECT name
+        FROM `tabColis`
+        WHERE bl = %s AND docstatus < 2
+    """, (delivery_note_name,))
+
+    if names:
+        frappe.db.sql("""
+            UPDATE `tabColis` c
+            INNER JOIN (
+                SELECT name, ROW_NUMBER() OVER (ORDER BY creation ASC, name ASC) AS seq
+                FROM `tabColis`
+                WHERE bl = %(dn)s AND docstatus < 2
+            ) s ON s.name = c.name
+            SET c.custom_numero_sequence = CONCAT(s.seq, '/', %(total)s)
+            WHERE COALESCE(c.custom_numero_sequence, '') != CONCAT(s.seq, '/', %(total)s)
+        """, {"dn": delivery_note_name, "total": len(names)})
+
+    return names
+
 def _update_sequences(delivery_note_name):
     """
     Re-calcule custom_numero_sequence pour chaque Colis lié
@@ -94,179 +172,57 @@ def _update_sequences(delivery_note_name):
     try:
         # Vérifier que la Delivery Note existe
         if not frappe.db.exists("Delivery Note", delivery_note_name):
-            frappe.log_error(f"Delivery Note {delivery_note_name} n'existe pas", 
-                           "Erreur mise à jour séquences Colis")
+            logger.warning("sequences", "delivery_note_missing", delivery_note=delivery_note_name)
             return
         
-        # Forcer une requête SQL directe pour vérifier les colis liés
-        # en contournant le cache potentiellement obsolète
-        sql_query = """
-            SELECT name 
-            FROM `tabColis` 
-            WHERE bl = %s AND docstatus < 2
-            ORDER BY creation ASC
-        """
-        docs_result = frappe.db.sql(sql_query, (delivery_note_name,), as_dict=True)
+        # Renuméroter tous les colis liés en une seule requête
+        colis_names = _renumber_colis(delivery_note_name)
+        total = len(colis_names)
+        logger.debug("sequences", "colis_renumbered", delivery_note=delivery_note_name, total=total)
         
-        # Vérifier si des colis sont encore liés à cette DN
-        total = len(docs_result)
-        frappe.log_error(f"Nombre de colis trouvés pour DN {delivery_note_name}: {total}", 
-                       "Debug mise à jour séquences")
-        
-        # Mettre à jour la séquence pour chaque Colis
-        for idx, d in enumerate(docs_result, start=1):
-            try:
-                frappe.db.set_value("Colis", d.name,
-                    "custom_numero_sequence", f"{idx}/{total}",
-                    update_modified=False)
-            except Exception as e:
-                frappe.log_error(f"Erreur lors de la mise à jour de la séquence pour Colis {d.name}: {str(e)}", 
-                               "Erreur mise à jour séquences Colis")
-        
-        # Mettre à jour le nombre total de Colis sur la Delivery Note avec une requête SQL directe
-        try:
-            # Utiliser une requête SQL directe pour mettre à jour le champ
-            update_query = """
-                UPDATE `tabDelivery Note`
-                SET custom_nombre_colis = %s
-                WHERE name = %s
-            """
-            frappe.db.sql(update_query, (total, delivery_note_name))
-            
-            # Vérifier que la mise à jour a bien été effectuée
-            check_query = "SELECT custom_nombre_colis FROM `tabDelivery Note` WHERE name = %s"
-            result = frappe.db.sql(check_query, (delivery_note_name,), as_dict=True)
-            if result and len(result) > 0:
-                frappe.log_error(f"Valeur de custom_nombre_colis après mise à jour: {result[0].custom_nombre_colis}", 
-                               "Debug mise à jour nombre colis")
-        except Exception as e:
-            frappe.log_error(f"Erreur lors de la mise à jour du nombre de colis pour DN {delivery_note_name}: {str(e)}", 
-                           "Erreur mise à jour nombre colis")
-        
-        # S'assurer que les modifications sont bien enregistrées
-        frappe.db.commit()
+        # Mettre à jour le nombre total de Colis sur la Delivery Note
+        frappe.db.set_value("Delivery Note", delivery_note_name,
+            "custom_nombre_colis", total, update_modified=False)
         
-        # Invalider le cache pour s'assurer que les modifications sont visibles
-        frappe.clear_cache(doctype="Delivery Note")
-        frappe.clear_cache(doctype="Colis")
+        # Invalider uniquement les documents modifiés
+        invalidate_documents("Delivery Note", delivery_note_name)
+        invalidate_documents("Colis", colis_names)
         
     except Exception as e:
-        frappe.log_error(f"Erreur générale lors de la mise à jour des séquences pour DN {delivery_note_name}: {str(e)}", 
-                       "Erreur mise à jour séquences")
-        # Essayer de faire un commit même en cas d'erreur pour sauvegarder ce qui a pu être fait
-        frappe.db.commit()
+        logger.error("sequences", "sequence_update_failed", title="Erreur mise à jour séquences",
+            delivery_note=delivery_note_name, error=str(e))
 
-def _update_sequences_after_delete(delivery_note_name):
+def refresh_colis_sequences(delivery_note_name):
     """
-    Version spéciale de _update_sequences qui s'exécute après suppression
-    avec un délai pour s'assurer que la suppression est complètement terminée.
+    Job exécuté après la suppression de colis : renumérote les colis restants
+    de la DN. Dédoublonné par DN, une suppression en masse ne provoque qu'un recalcul.
     """
-    try:
-        # Attendre un court instant pour s'assurer que la suppression est complètement terminée
-        time.sleep(3)
-        
-        # Vérifier que la Delivery Note existe
-        if not frappe.db.exists("Delivery Note", delivery_note_name):
-            frappe.log_error(f"Delivery Note {delivery_note_name} n'existe pas", 
-                           "Erreur mise à jour séquences après suppression")
-            return
-        
-        # Forcer une nouvelle connexion à la base de données pour éviter les problèmes de cache
-        frappe.db.commit()
-        
-        # Requête SQL directe pour récupérer les colis restants
-        colis_query = """
-            SELECT name 
-            FROM `tabColis` 
-            WHERE bl = %s AND docstatus < 2
-            ORDER BY creation ASC
-        """
-        colis_result = frappe.db.sql(colis_query, (delivery_note_name,), as_dict=True)
-        total = len(colis_result)
-        
-        frappe.log_error(f"Nombre de colis restants après suppression pour DN {delivery_note_name}: {total}", 
-                       "Debug mise à jour après suppression")
-        
-        # Mettre à jour les séquences des colis restants
-        for idx, colis in enumerate(colis_result, start=1):
-            try:
-                sequence_update = """
-                    UPDATE `tabColis`
-                    SET custom_numero_sequence = %s
-                    WHERE name = %s
-                """
-                frappe.db.sql(sequence_update, (f"{idx}/{total}", colis.name))
-            except Exception as e:
-                frappe.log_error(f"Erreur lors de la mise à jour de la séquence pour Colis {colis.name}: {str(e)}", 
-                               "Erreur mise à jour séquences Colis")
-        
-        # Mettre à jour le nombre total de Colis sur la Delivery Note
-        try:
-            # Utiliser frappe.db.set_value pour une mise à jour plus fiable
-            frappe.db.set_value("Delivery Note", delivery_note_name, "custom_nombre_colis", total, update_modified=False)
-            
-            # Alternative avec SQL direct si set_value ne fonctionne pas
-            update_query = """
-                UPDATE `tabDelivery Note`
-                SET custom_nombre_colis = %s, modified = modified
-                WHERE name = %s
-            """
-            frappe.db.sql(update_query, (total, delivery_note_name))
-            
-            frappe.log_error(f"Mise à jour du nombre de colis à {total} pour DN {delivery_note_name}", 
-                           "Debug mise à jour après suppression")
-            
-        except Exception as e:
-            frappe.log_error(f"Erreur lors de la mise à jour du nombre de colis pour DN {delivery_note_name}: {str(e)}", 
-                           "Erreur mise à jour nombre colis")
-        
-        # S'assurer que les modifications sont bien enregistrées
-        frappe.db.commit()
-        
-        # Invalider le cache de manière plus agressive
-        frappe.clear_cache(doctype="Delivery Note")
-        frappe.clear_cache(doctype="Colis")
-        frappe.clear_document_cache("Delivery Note", delivery_note_name)
-        
-        # Vérification finale avec plusieurs tentatives
-        for attempt in range(3):
-            check_query = "SELECT custom_nombre_colis FROM `tabDelivery Note` WHERE name = %s"
-            result = frappe.db.sql(check_query, (delivery_note_name,), as_dict=True)
-            if result and len(result) > 0:
-                final_value = result[0].custom_nombre_colis
-                frappe.log_error(f"Tentative {attempt + 1} - Valeur de custom_nombre_colis: {final_value}", 
-                               "Debug vérification finale")
-                if final_value == total:
-                    frappe.log_error(f"Mise à jour réussie après {attempt + 1} tentative(s)", 
-                                   "Debug vérification finale")
-                    break
-            time.sleep(1)
-        
-    except Exception as e:
-        frappe.log_error(f"Erreur lors de la mise à jour après suppression pour DN {delivery_note_name}: {str(e)}", 
-                       "Erreur mise à jour après suppression")
-        frappe.db.commit()
+    release_coalesced(_sequence_job_key(delivery_note_name))
+    _update_sequences(delivery_note_name)
+
+def _schedule_sequence_refresh(delivery_note_name):
+    enqueue_coalesced(
+        "log.delivery_note_hooks.refresh_colis_sequences",
+        _sequence_job_key(delivery_note_name),
+        delivery_note_name=delivery_note_name,
+    )
+
+def _sequence_job_key(delivery_note_name):
+    return f"colis_sequences::{delivery_note_name}"
 
 def validate_colis_quantities(doc, method):
     """
     Bloque si somme(qtés des autres colis + qtés de ce colis)
     > qtés de la DN.
     """
-    if not doc.bl:
+    if not doc.bl or doc.flags.colis_quantities_validated:
         return
 
-    dn = frappe.get_doc("Delivery Note", doc.bl)
-    dn_qty = {i.item_code: i.qty for i in dn.items}
-
-    autres = [c.name for c in frappe.get_all("Colis",
-        filters={"bl": doc.bl, "name": ("!=", doc.name)},
-        fields=["name"])]
-    cumul = {}
-    if autres:
-        for r in frappe.get_all("Articles Colis",
-            filters={"parent": ["in", autres]},
-            fields=["article", "quantite_totale"]):
-            cumul[r.article] = cumul.get(r.article, 0) + (r.quantite_totale or 0)
+    lock_delivery_note(doc.bl)
+    dn_qty = {code: info["qty"] for code, info in get_delivery_note_quantities(doc.bl).items()}
+    cumul = get_packed_quantities(doc.bl, exclude_colis=doc.name, locking_read=True)
+    logger.debug("packing", "validate_quantities", sample_rate=0.1,
+        colis=doc.name, delivery_note=doc.bl, lines=len(doc.articles))
 
     for line in doc.articles:
         code = line.article
@@ -277,67 +233,24 @@ def validate_colis_quantities(doc, method):
                 "{1} déjà colisé + {2} ici > {3} sur la DN."
             ).format(code, cumul.get(code, 0), qt, dn_qty.get(code, 0)))
 
-def on_trash_colis(doc, method):
-    """
-    Hook on_trash pour le DocType Colis.
-    Stocke l'information pour traitement ultérieur.
-    """
-    try:
-        if doc.bl:
-            frappe.log_error(f"on_trash du colis {doc.name} pour la DN {doc.bl}", 
-                           "Debug on_trash_colis")
-            # Stocker l'information dans la session pour traitement par after_delete
-            if not hasattr(frappe.local, 'colis_to_update'):
-                frappe.local.colis_to_update = set()
-            frappe.local.colis_to_update.add(doc.bl)
-            
-    except Exception as e:
-        frappe.log_error(f"Erreur dans on_trash_colis pour {doc.name}: {str(e)}", 
-                       "Erreur on_trash_colis")
-
 def after_delete_colis(doc, method):
     """
-    Hook after_delete pour s'assurer que la mise à jour se fait après suppression complète.
-    Exécution directe et synchrone pour éviter les problèmes de timing.
+    Hook after_delete : la renumérotation des colis restants est confiée
+    à un job exécuté après le commit de la suppression.
     """
-    try:
-        if doc.bl:
-            frappe.log_error(f"After delete du colis {doc.name} pour la DN {doc.bl}", 
-                           "Debug after_delete_colis")
-            
-            # Exécuter directement la mise à jour après un court délai
-            time.sleep(1)  # Délai court pour s'assurer que la suppression est terminée
-            _update_sequences_after_delete(doc.bl)
-            
-    except Exception as e:
-        frappe.log_error(f"Erreur dans after_delete_colis pour {doc.name}: {str(e)}", 
-                       "Erreur after_delete_colis")
-        # En cas d'erreur, essayer une seconde fois après un délai plus long
-        if doc.bl:
-            try:
-                time.sleep(2)
-                _update_sequences_after_delete(doc.bl)
-            except Exception as inner_e:
-                frappe.log_error(f"Échec de la récupération pour DN {doc.bl}: {str(inner_e)}", 
-                               "Erreur critique after_delete_colis")
+    if doc.bl:
+        logger.debug("sequences", "refresh_scheduled", colis=doc.name, delivery_note=doc.bl)
+        _schedule_sequence_refresh(doc.bl)
 
 @frappe.whitelist()
 def get_unpacked_items(delivery_note_name):
     """
     Retourne la liste des articles de la DN avec leurs quantités non emballées.
     """
-    dn = frappe.get_doc("Delivery Note", delivery_note_name)
-    dn_qty = {item.item_code: {"qty": item.qty, "description": item.description or item.item_code} for item in dn.items}
+    dn_qty = get_delivery_note_quantities(delivery_note_name)
 
     # Cumul des quantités déjà en Colis
-    noms = [c.name for c in frappe.get_all("Colis",
-        filters={"bl": delivery_note_name}, fields=["name"])]
-    cumul = {}
-    if noms:
-        for r in frappe.get_all("Articles Colis",
-            filters={"parent": ["in", noms]},
-            fields=["article", "quantite_totale"]):
-            cumul[r.article] = cumul.get(r.article, 0) + (r.quantite_totale or 0)
+    cumul = get_packed_quantities(delivery_note_name)
 
     # Calculer les quantités restantes
     unpacked_items = []
@@ -357,6 +270,60 @@ def get_unpacked_items(delivery_note_name):
     
     return unpacked_items
 
+@frappe.whitelist()
+def get_delivery_note_indicators(delivery_note_names):
+    """
+    Indicateurs colis pour une page de DN (vue liste), en trois requêtes
+    agrégées quel que soit le nombre de DN :
+    {dn: {"colis_count", "ordered_qty", "packed_qty", "can_create_colis"}}
+    """
+    if isinstance(delivery_note_names, str):
+        delivery_note_names = frappe.parse_json(delivery_note_names)
+    names = tuple(dict.fromkeys(delivery_note_names or []))
+    if not names:
+        return {}
+
+    frappe.has_permission("Delivery Note", "read", throw=True)
+
+    ordered = {}
+    for r in frappe.db.sql("""
+        SELECT parent, item_code, SUM(qty) AS qty
+        FROM `tabDelivery Note Item`
+        WHERE parent IN %s AND parenttype = 'Delivery Note'
+        GROUP BY parent, item_code
+    """, (names,), as_dict=True):
+        ordered.setdefault(r.parent, {})[r.item_code] = r.qty or 0
+
+    packed = {}
+    for r in frappe.db.sql("""
+        SELECT c.bl, ac.article, SUM(ac.quantite_totale) AS qty
+        FROM `tabArticles Colis` ac
+        INNER JOIN `tabColis` c ON c.name = ac.parent
+        WHERE c.bl IN %s AND ac.parenttype = 'Colis'
+        GROUP BY c.bl, ac.article
+    """, (names,), as_dict=True):
+        packed.setdefault(r.bl, {})[r.article] = r.qty or 0
+
+    colis_count = dict(frappe.db.sql("""
+        SELECT bl, COUNT(*)
+        FROM `tabColis`
+        WHERE bl IN %s AND docstatus < 2
+        GROUP BY bl
+    """, (names,)))
+
+    indicators = {}
+    for name in names:
+        dn_qty = ordered.get(name, {})
+        cumul = packed.get(name, {})
+        indicators[name] = {
+            "colis_count": colis_count.get(name, 0),
+            "ordered_qty": sum(dn_qty.values()),
+            "packed_qty": sum(cumul.values()),
+            "can_create_colis": any(qty - cumul.get(code, 0) > 0 for code, qty in dn_qty.items()),
+        }
+
+    return indicators
+
 @frappe.whitelist()
 def force_update_colis_count(delivery_note_name):
     """
@@ -364,10 +331,10 @@ def force_update_colis_count(delivery_note_name):
     Peut être appelée depuis la console ou un script personnalisé.
     """
     try:
-        frappe.log_error(f"Force update pour DN {delivery_note_name}", "Force update colis count")
-        _update_sequences_after_delete(delivery_note_name)
+        logger.info("sequences", "force_update", delivery_note=delivery_note_name, user=frappe.session.user)
+        _update_sequences(delivery_note_name)
         return {"success": True, "message": "Mise à jour forcée effectuée"}
     except Exception as e:
-        frappe.log_error(f"Erreur lors de la mise à jour forcée pour DN {delivery_note_name}: {str(e)}", 
-                       "Erreur force update")
+        logger.error("sequences", "force_update_failed", title="Erreur force update",
+            delivery_note=delivery_note_name, error=str(e))
         return {"success": False, "message": str(e)}
@@ -0,0 +1,89 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Synchronisation des quantités livrées des Colis vers leur Delivery Note.
+
+La synchronisation est différée dans un job unique par Delivery Note :
+plusieurs colis modifiés à la suite ne provoquent qu'une écriture, limitée
+aux lignes dont la quantité livrée a changé.
+"""
+
+import frappe
+
+from log import logger
+from log.utils import enqueue_coalesced, invalidate_documents, release_coalesced
+
+
+def schedule_delivery_note_sync(delivery_note_name):
+	"""Programme la synchronisation de la DN après le commit (dédoublonnée par DN)"""
+	if not delivery_note_name:
+		return
+
+	enqueue_coalesced(
+		"log.delivery_note_sync.sync_delivery_note",
+		_sync_key(delivery_note_name),
+		delivery_note_name=delivery_note_name,
+	)
+
+
+def sync_delivery_note(delivery_note_name):
+	"""Job : reporte sur les lignes de la DN le cumul livré de tous ses colis"""
+	release_coalesced(_sync_key(delivery_note_name))
+
+	if not frappe.get_meta("Delivery Note Item").has_field("delivered_qty"):
+		return
+
+	delivered = get_delivered_quantities(delivery_note_name)
+	if not delivered:
+		return
+
+	items = frappe.db.sql(
+		"""
+		SELECT name, item_code, qty, delivered_qty
+		FROM `tabDelivery Note Item`
+		WHERE parent = %s AND parenttype = 'Delivery Note'
+		ORDER BY idx
+		""",
+		(delivery_note_name,),
+		as_dict=True,
+	)
+
+	changed = 0
+	for item in items:
+		if item.item_code not in delivered:
+			continue
+
+		# Répartir le cumul livré sur les lignes de l'article, sans dépasser la quantité commandée
+		new_delivered_qty = min(delivered[item.item_code], item.qty or 0)
+		delivered[item.item_code] -= new_delivered_qty
+
+		if new_delivered_qty != (item.delivered_qty or 0):
+			frappe.db.set_value(
+				"Delivery Note Item", item.name, "delivered_qty", new_delivered_qty, update_modified=False
+			)
+			changed += 1
+
+	if changed:
+		invalidate_documents("Delivery Note", delivery_note_name)
+
+	logger.debug("delivery_note_sync", "synced", delivery_note=delivery_note_name, changed_lines=changed)
+
+
+def get_delivered_quantities(delivery_note_name):
+	"""Retourne {article: quantité livrée} cumulée sur tous les Colis de la DN"""
+	rows = frappe.db.sql(
+		"""
+		SELECT ac.article, SUM(ac.quantite_livree) AS qty
+		FROM `tabArticles Colis` ac
+		INNER JOIN `tabColis` c ON c.name = ac.parent
+		WHERE c.bl = %s AND ac.parenttype = 'Colis'
+		GROUP BY ac.article
+		""",
+		(delivery_note_name,),
+		as_dict=True,
+	)
+	return {r.article: r.qty or 0 for r in rows if r.article}
+
+
+def _sync_key(delivery_note_name):
+	return f"dn_sync::{delivery_note_name}"
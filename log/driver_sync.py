@@ -0,0 +1,293 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Synchronisation différentielle de l'application livreurs.
+
+`get_changes` renvoie, depuis un curseur (filigrane sur `modified`), les colis
+de la tournée du livreur connecté qui ont changé, avec leurs articles, et les
+colis supprimés. `apply_mutations` rejoue en un aller-retour les livraisons
+saisies hors ligne ; chaque mutation porte une clé d'idempotence, et une
+mutation déjà appliquée renvoie son résultat initial sans être rejouée.
+"""
+
+from datetime import timedelta
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, cint, flt, get_datetime, getdate, now_datetime
+
+from log import colis_delivery
+
+# Recouvrement appliqué au curseur : couvre les transactions validées après
+# la lecture précédente avec une date `modified` antérieure au curseur
+CURSOR_OVERLAP = timedelta(seconds=5)
+# Tournée : bons de livraison du livreur sur les N derniers jours
+# (surchargeable par `log_driver_tour_days` dans site_config.json)
+DEFAULT_TOUR_DAYS = 7
+
+IDEMPOTENCY_KEY = "log:driver_mutation"
+IDEMPOTENCY_TTL = 7 * 24 * 60 * 60
+# Réservation d'une mutation en cours : un renvoi concurrent ne la rejoue pas
+CLAIM_TTL = 60
+MAX_MUTATIONS = 200
+
+ARTICLE_SYNC_FIELDS = (
+	"name",
+	"article",
+	"statut_article",
+	"quantite_totale",
+	"quantite_livree",
+	"quantite_restante",
+	"date_derniere_livraison",
+	"raison_non_livraison",
+	"commentaire_article",
+)
+
+MUTATIONS = {
+	"deliver_quantity": lambda m: colis_delivery.deliver_quantity(m["colis"], m["article"], _get_quantity(m)),
+	"deliver_remaining": lambda m: colis_delivery.deliver_remaining(m["colis"], m["article"]),
+	"mark_undeliverable": lambda m: colis_delivery.mark_undeliverable(
+		m["colis"], m["article"], m.get("reason") or ""
+	),
+	"deliver_all": lambda m: colis_delivery.deliver_all(m["colis"]),
+}
+
+
+@frappe.whitelist(methods=["GET"])
+def get_changes(cursor=None):
+	"""Retourne les changements de la tournée du livreur depuis `cursor`
+
+	Args:
+		cursor (str): Le curseur renvoyé par l'appel précédent (aucun : synchronisation complète)
+
+	Returns:
+		dict: `cursor` (à renvoyer au prochain appel), `delivery_notes` (la tournée
+		complète, pour écarter les colis qui n'en font plus partie), `colis`
+		(modifiés, avec leurs articles) et `deleted` (noms des colis supprimés de la tournée)
+	"""
+	driver = get_current_driver()
+	new_cursor = now_datetime()
+	since = get_datetime(cursor) - CURSOR_OVERLAP if cursor else None
+
+	delivery_notes = get_tour_delivery_notes(driver)
+	colis = _get_changed_colis(delivery_notes, since)
+
+	articles = {}
+	if colis:
+		for article in frappe.db.sql(
+			f"""
+			SELECT parent, {", ".join(ARTICLE_SYNC_FIELDS)}
+			FROM `tabArticles Colis`
+			WHERE parent IN %s AND parenttype = 'Colis'
+			ORDER BY parent, idx
+			""",
+			(tuple(c.name for c in colis),),
+			as_dict=True,
+		):
+			articles.setdefault(article.pop("parent"), []).append(article)
+
+	for c in colis:
+		c["articles"] = articles.get(c.name, [])
+
+	deleted = _get_deleted_colis(delivery_notes, since) if since else []
+
+	return {
+		"cursor": str(new_cursor),
+		"delivery_notes": delivery_notes,
+		"colis": colis,
+		"deleted": deleted,
+	}
+
+
+@frappe.whitelist(methods=["POST"])
+def apply_mutations(mutations):
+	"""Applique une file de livraisons saisies hors ligne
+
+	Args:
+		mutations (list): Dicts `id` (clé d'idempotence), `action`
+			(deliver_quantity, deliver_remaining, mark_undeliverable, deliver_all),
+			`colis`, et selon l'action `article`, `quantity`, `reason`
+
+	Returns:
+		dict: `results`, un résultat par mutation dans l'ordre reçu (avec son `id`) ;
+		`retry` signale une mutation non appliquée à renvoyer plus tard (erreur
+		inattendue ou mutation déjà en cours), les autres échecs sont définitifs
+	"""
+	frappe.has_permission("Colis", "write", throw=True)
+	driver = get_current_driver()
+
+	mutations = frappe.parse_json(mutations) or []
+	if len(mutations) > MAX_MUTATIONS:
+		frappe.throw(_("Trop de mutations dans un seul envoi (maximum {0})").format(MAX_MUTATIONS))
+
+	owned = _get_driver_colis(driver, {m.get("colis") for m in mutations if m.get("colis")})
+	results = []
+	applied = {}
+
+	for mutation in mutations:
+		mutation_id = mutation.get("id")
+		if not mutation_id:
+			results.append({"id": None, "success": False, "message": _("Clé d'idempotence manquante")})
+			continue
+
+		result = applied.get(mutation_id) or frappe.cache.get_value(_idempotency_key(mutation_id))
+		if result is None and mutation_id not in applied:
+			if not _claim(mutation_id):
+				result = {
+					"success": False,
+					"pending": True,
+					"retry": True,
+					"message": _("Mutation déjà en cours de traitement"),
+				}
+			else:
+				result = _apply_mutation(mutation, owned)
+				if not result.get("retry"):
+					applied[mutation_id] = result
+					_remember_result(mutation_id, result)
+
+		results.append({"id": mutation_id, **result})
+
+	return {"results": results}
+
+
+def get_current_driver():
+	"""Retourne le Livreur lié à l'utilisateur connecté"""
+	driver = frappe.db.get_value("Livreur", {"id_utilisateur": frappe.session.user}, "name")
+	if not driver:
+		frappe.throw(
+			_("Aucun livreur n'est associé à l'utilisateur {0}").format(frappe.session.user),
+			frappe.PermissionError,
+		)
+	return driver
+
+
+def get_tour_delivery_notes(driver):
+	"""Bons de livraison non annulés du livreur sur la période de la tournée"""
+	tour_days = cint(frappe.conf.get("log_driver_tour_days")) or DEFAULT_TOUR_DAYS
+	return frappe.get_all(
+		"Delivery Note",
+		filters={
+			"custom_livreur": driver,
+			"docstatus": ["<", 2],
+			"posting_date": [">=", add_days(getdate(), -tour_days)],
+		},
+		pluck="name",
+		order_by="name asc",
+	)
+
+
+def _get_changed_colis(delivery_notes, since):
+	if not delivery_notes:
+		return []
+
+	# Un colis a changé si sa ligne ou l'un de ses articles a été modifié
+	condition = (
+		"""
+		AND (c.modified > %(since)s OR EXISTS (
+			SELECT 1 FROM `tabArticles Colis` ac
+			WHERE ac.parent = c.name AND ac.parenttype = 'Colis' AND ac.modified > %(since)s
+		))
+		"""
+		if since
+		else ""
+	)
+
+	return frappe.db.sql(
+		f"""
+		SELECT c.name, c.custom_numero_sequence, c.status, c.client, c.bl, c.date, c.modified
+		FROM `tabColis` c
+		WHERE c.bl IN %(delivery_notes)s {condition}
+		ORDER BY c.bl, c.custom_numero_sequence
+		""",
+		{"delivery_notes": tuple(delivery_notes), "since": since},
+		as_dict=True,
+	)
+
+
+def _get_deleted_colis(delivery_notes, since):
+	"""Colis de la tournée supprimés depuis `since` (bon de livraison lu dans la copie supprimée)"""
+	if not delivery_notes:
+		return []
+
+	tour = set(delivery_notes)
+	deleted = frappe.get_all(
+		"Deleted Document",
+		filters={"deleted_doctype": "Colis", "creation": [">", since]},
+		fields=["deleted_name", "data"],
+	)
+	return [row.deleted_name for row in deleted if frappe.parse_json(row.data or "{}").get("bl") in tour]
+
+
+def _get_driver_colis(driver, colis_names):
+	if not colis_names:
+		return set()
+
+	return set(
+		frappe.db.sql_list(
+			"""
+			SELECT c.name
+			FROM `tabColis` c
+			INNER JOIN `tabDelivery Note` dn ON dn.name = c.bl
+			WHERE c.name IN %s AND dn.custom_livreur = %s
+			""",
+			(tuple(colis_names), driver),
+		)
+	)
+
+
+def _apply_mutation(mutation, owned):
+	"""Applique une mutation dans un point de sauvegarde
+
+	Un refus (action inconnue, colis hors tournée, erreur de validation) est
+	définitif et mémorisé ; une erreur inattendue ne l'est pas (`retry`), pour
+	que la mutation puisse être renvoyée.
+	"""
+	operation = MUTATIONS.get(mutation.get("action"))
+	if not operation:
+		return {"success": False, "message": _("Action inconnue : {0}").format(mutation.get("action"))}
+	if mutation.get("colis") not in owned:
+		return {
+			"success": False,
+			"message": _("Le colis {0} ne fait pas partie de votre tournée").format(mutation.get("colis")),
+		}
+
+	frappe.db.savepoint("driver_sync")
+	try:
+		return operation(mutation)
+	except frappe.ValidationError as e:
+		frappe.db.rollback(save_point="driver_sync")
+		return {"success": False, "message": str(e)}
+	except Exception as e:
+		frappe.db.rollback(save_point="driver_sync")
+		frappe.log_error(f"Synchronisation livreur: {e}")
+		return {"success": False, "retry": True, "message": _("Erreur inattendue, réessayez")}
+
+
+def _get_quantity(mutation):
+	# Les quantités des Articles Colis sont entières, comme pour deliver_article_quantity
+	quantity = mutation.get("quantity")
+	if flt(quantity) != cint(quantity):
+		frappe.throw(_("La quantité à livrer doit être un nombre entier"))
+	return cint(quantity)
+
+
+def _claim(mutation_id):
+	"""Réserve la mutation jusqu'à la fin de la transaction (libérée au commit ou au rollback)"""
+	key = frappe.cache.make_key(f"{_idempotency_key(mutation_id)}:claim")
+	if not frappe.cache.set(key, 1, nx=True, ex=CLAIM_TTL):
+		return False
+
+	frappe.db.after_commit.add(lambda: frappe.cache.delete(key))
+	frappe.db.after_rollback.add(lambda: frappe.cache.delete(key))
+	return True
+
+
+def _remember_result(mutation_id, result):
+	# Mémorisé seulement si la transaction est validée : sinon la mutation sera rejouée
+	frappe.db.after_commit.add(
+		lambda: frappe.cache.set_value(_idempotency_key(mutation_id), result, expires_in_sec=IDEMPOTENCY_TTL)
+	)
+
+
+def _idempotency_key(mutation_id):
+	return f"{IDEMPOTENCY_KEY}:{frappe.session.user}:{mutation_id}"
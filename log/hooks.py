@@ -143,9 +143,16 @@ doc_events = {
                 "log.log.customer_hooks.uppercase_customer_name",
             ]
         },
+    "Contact": {
+        "on_update": "log.log.customer_hooks.on_contact_change",
+        "on_trash": "log.log.customer_hooks.on_contact_change"
+    },
+    "Item": {
+        "on_update": "log.item_barcode.on_item_change",
+        "on_trash": "log.item_barcode.on_item_change"
+    },
     "Colis": {
         "validate": "log.delivery_note_hooks.validate_colis_quantities",
-        "on_trash": "log.delivery_note_hooks.on_trash_colis",
         "after_delete": "log.delivery_note_hooks.after_delete_colis"
     }
 }
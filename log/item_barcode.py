@@ -0,0 +1,122 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Résolution code-barres → article, avec deux niveaux de cache.
+
+1. un LRU en mémoire du processus, à durée de vie courte (LOCAL_TTL) ;
+2. un hash Redis partagé entre les workers, invalidé à la modification
+   des codes-barres ou du nom d'un article.
+
+Un code-barres modifié depuis un autre worker peut donc rester résolu
+avec l'ancienne valeur au plus LOCAL_TTL secondes dans ce processus.
+"""
+
+import time
+from collections import OrderedDict
+
+import frappe
+
+REDIS_KEY = "log:barcode_item"
+LOCAL_TTL = 30
+LOCAL_MAX_SIZE = 4096
+
+# (site, code-barres) -> (expiration, article ou None)
+_local_cache = OrderedDict()
+
+
+def resolve_barcode(barcode):
+	"""Retourne l'article {name, item_name} correspondant au code-barres, ou None"""
+	return resolve_barcodes([barcode]).get(barcode)
+
+
+def resolve_barcodes(barcodes):
+	"""Résout une liste de codes-barres
+
+	Args:
+		barcodes (list): Les codes-barres à rechercher
+
+	Returns:
+		dict: {code-barres: {name, item_name} ou None}
+	"""
+	barcodes = [b for b in dict.fromkeys(barcodes or []) if b]
+	result = {}
+
+	missing = []
+	now = time.monotonic()
+	for barcode in barcodes:
+		entry = _local_cache.get((frappe.local.site, barcode))
+		if entry and entry[0] > now:
+			_local_cache.move_to_end((frappe.local.site, barcode))
+			result[barcode] = entry[1]
+		else:
+			missing.append(barcode)
+
+	if missing:
+		for barcode in missing:
+			item = frappe.cache.hget(REDIS_KEY, barcode)
+			if item is not None:
+				result[barcode] = item
+				_remember(barcode, item)
+
+		missing = [barcode for barcode in missing if barcode not in result]
+
+	if missing:
+		found = _fetch_from_db(missing)
+		for barcode in missing:
+			item = found.get(barcode)
+			result[barcode] = item
+			_remember(barcode, item)
+			# Seules les correspondances trouvées sont partagées ; les échecs restent locaux
+			if item is not None:
+				frappe.cache.hset(REDIS_KEY, barcode, item)
+
+	return result
+
+
+def clear_barcode_cache(barcodes=None):
+	"""Invalide le cache pour les codes-barres donnés (tous si None)"""
+	if barcodes is None:
+		frappe.cache.delete_value(REDIS_KEY)
+		_local_cache.clear()
+		return
+
+	for barcode in barcodes:
+		frappe.cache.hdel(REDIS_KEY, barcode)
+		_local_cache.pop((frappe.local.site, barcode), None)
+
+
+def on_item_change(doc, method=None):
+	"""Hook Item : invalide les codes-barres ajoutés, retirés ou dont l'article a changé de nom"""
+	barcodes = {row.barcode for row in doc.get("barcodes") or [] if row.barcode}
+
+	before = doc.get_doc_before_save() if method != "on_trash" else None
+	if before:
+		previous = {row.barcode for row in before.get("barcodes") or [] if row.barcode}
+		if previous == barcodes and before.item_name == doc.item_name:
+			return
+		barcodes |= previous
+
+	if barcodes:
+		clear_barcode_cache(barcodes)
+
+
+def _fetch_from_db(barcodes):
+	rows = frappe.db.sql(
+		"""
+		SELECT ib.barcode, i.name, i.item_name
+		FROM `tabItem Barcode` ib
+		INNER JOIN `tabItem` i ON i.name = ib.parent
+		WHERE ib.barcode IN %s AND ib.parenttype = 'Item'
+		""",
+		(tuple(barcodes),),
+		as_dict=True,
+	)
+	return {row.barcode: frappe._dict(name=row.name, item_name=row.item_name) for row in rows}
+
+
+def _remember(barcode, item):
+	key = (frappe.local.site, barcode)
+	_local_cache[key] = (time.monotonic() + LOCAL_TTL, item)
+	_local_cache.move_to_end(key)
+	while len(_local_cache) > LOCAL_MAX_SIZE:
+		_local_cache.popitem(last=False)
@@ -1,5 +1,11 @@
 import frappe
 
+from log.utils import record_invalidation
+
+# Hash Redis : un champ par client, contenant la liste de ses contacts
+CONTACTS_CACHE_KEY = "log:customer_contacts"
+
+
 def uppercase_customer_name(doc, method):
     # Convertir le nom du client en majuscules s'il existe
     if doc.customer_name:
@@ -8,20 +14,95 @@ def uppercase_customer_name(doc, method):
 
 @frappe.whitelist()
 def get_customer_contacts(customer):
-    contacts_data = frappe.db.sql("""
-        SELECT 
+    return get_customers_contacts([customer]).get(customer, [])
+
+
+@frappe.whitelist()
+def get_customers_contacts(customers):
+    """Retourne les contacts de plusieurs clients (feuilles de route), par client.
+
+    Les clients absents du cache sont chargés en une seule requête.
+    """
+    frappe.has_permission("Customer", "read", throw=True)
+
+    customers = [customer for customer in frappe.parse_json(customers) or [] if customer]
+    result = {}
+    missing = []
+
+    for customer in dict.fromkeys(customers):
+        contacts = frappe.cache.hget(CONTACTS_CACHE_KEY, _normalize(customer))
+        if contacts is None:
+            missing.append(customer)
+        else:
+            result[customer] = contacts
+
+    if missing:
+        # La collation MariaDB ignore la casse et les espaces finaux : regrouper
+        # sur la même clé normalisée le `link_name` stocké et le nom demandé
+        loaded = {_normalize(customer): [] for customer in missing}
+        for contact in _query_customers_contacts(missing):
+            loaded.setdefault(_normalize(contact.pop("customer")), []).append(contact)
+
+        for key, contacts in loaded.items():
+            frappe.cache.hset(CONTACTS_CACHE_KEY, key, contacts)
+        for customer in missing:
+            result[customer] = loaded[_normalize(customer)]
+
+    return result
+
+
+def _normalize(name):
+    return name.rstrip().casefold()
+
+
+def _query_customers_contacts(customers):
+    # Partir de `tabDynamic Link` (index link_doctype, link_name) ; le mobile et
+    # l'email principaux sont lus par des sous-requêtes sur la clé parent
+    return frappe.db.sql("""
+        SELECT DISTINCT
+            dl.link_name AS customer,
             c.name AS docname,
             TRIM(CONCAT_WS(' ', c.first_name, c.last_name)) AS contact,
             c.designation,
-            MAX(CASE WHEN pn.is_primary_mobile_no = 1 THEN pn.phone END) AS mobile,
-            MAX(CASE WHEN e.is_primary = 1 THEN e.email_id END) AS email
-        FROM `tabContact` c
-        LEFT JOIN `tabDynamic Link` dl 
-            ON c.name = dl.parent AND dl.link_doctype = 'Customer' AND dl.link_name = %s
-        LEFT JOIN `tabContact Phone` pn ON c.name = pn.parent
-        LEFT JOIN `tabContact Email` e ON c.name = e.parent
-        WHERE dl.link_name IS NOT NULL
-        GROUP BY c.name
-    """, (customer,), as_dict=True)
-    
-    return contacts_data
\ No newline at end of file
+            (
+                SELECT MAX(pn.phone) FROM `tabContact Phone` pn
+                WHERE pn.parent = c.name AND pn.parenttype = 'Contact' AND pn.is_primary_mobile_no = 1
+            ) AS mobile,
+            (
+                SELECT MAX(e.email_id) FROM `tabContact Email` e
+                WHERE e.parent = c.name AND e.parenttype = 'Contact' AND e.is_primary = 1
+            ) AS email
+        FROM `tabDynamic Link` dl
+        INNER JOIN `tabContact` c ON c.name = dl.parent
+        WHERE dl.link_doctype = 'Customer' AND dl.link_name IN %s AND dl.parenttype = 'Contact'
+        ORDER BY dl.link_name, c.name
+    """, (tuple(customers),), as_dict=True)
+
+
+def clear_customer_contacts_cache(customers):
+    """Invalide les contacts en cache d'un ou plusieurs clients (maintenant et après le commit)"""
+    customers = [customer for customer in set(customers) if customer]
+    if not customers:
+        return
+
+    def clear():
+        for customer in customers:
+            frappe.cache.hdel(CONTACTS_CACHE_KEY, _normalize(customer))
+
+    clear()
+    frappe.db.after_commit.add(clear)
+    record_invalidation("customer_contacts", len(customers))
+
+
+def on_contact_change(doc, method=None):
+    # Clients liés avant et après la modification (un lien retiré invalide aussi l'ancien client)
+    customers = _get_linked_customers(doc)
+    before_save = doc.get_doc_before_save()
+    if before_save:
+        customers |= _get_linked_customers(before_save)
+
+    clear_customer_contacts_cache(customers)
+
+
+def _get_linked_customers(doc):
+    return {link.link_name for link in doc.get("links") or [] if link.link_doctype == "Customer"}
@@ -6,33 +6,42 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import now_datetime
 
+from log.colis_info import clear_colis_info_cache
+
+def compute_quantite_restante(quantite_totale, quantite_livree):
+	"""Quantité restante à livrer pour une ligne"""
+	if not quantite_totale:
+		return 0
+	return max(0, quantite_totale - (quantite_livree or 0))
+
+
+def compute_statut_article(quantite_totale, quantite_livree):
+	"""Statut d'une ligne selon les quantités"""
+	if not quantite_totale or not quantite_livree:
+		return "En attente"
+	if quantite_livree >= quantite_totale:
+		return "Livré"
+	return "Partiellement livré"
+
+
 class ArticlesColis(Document):
 	def validate(self):
 		"""Validation et calculs automatiques"""
 		self.calculate_quantite_restante()
 		self.update_statut_article()
 	
+	def on_update(self):
+		# Ligne enregistrée seule (hors sauvegarde du colis) : invalider la vue publique du colis
+		if self.parenttype == "Colis" and self.parent:
+			clear_colis_info_cache(self.parent)
+	
 	def calculate_quantite_restante(self):
 		"""Calculer la quantité restante"""
-		if self.quantite_totale and self.quantite_livree:
-			self.quantite_restante = max(0, self.quantite_totale - self.quantite_livree)
-		elif self.quantite_totale:
-			self.quantite_restante = self.quantite_totale
-		else:
-			self.quantite_restante = 0
+		self.quantite_restante = compute_quantite_restante(self.quantite_totale, self.quantite_livree)
 	
 	def update_statut_article(self):
 		"""Mettre à jour le statut de l'article selon les quantités"""
-		if not self.quantite_totale:
-			self.statut_article = "En attente"
-			return
-		
-		if self.quantite_livree == 0:
-			self.statut_article = "En attente"
-		elif self.quantite_livree >= self.quantite_totale:
-			self.statut_article = "Livré"
-		else:
-			self.statut_article = "Partiellement livré"
+		self.statut_article = compute_statut_article(self.quantite_totale, self.quantite_livree)
 	
 	def deliver_quantity(self, quantity_to_deliver, update_date=True):
 		"""Livrer une quantité spécifique"""
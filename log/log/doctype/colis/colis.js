@@ -22,6 +22,14 @@ frappe.ui.form.on("Colis", {
 		}
 	},
 	
+	before_save(frm) {
+		// Enregistrer d'abord les scans en attente (par lot), puis laisser la
+		// sauvegarde se poursuivre avec la table des articles à jour
+		if (frm.packing_session && frm.packing_session.docname === frm.doc.name) {
+			return vider_scans(frm);
+		}
+	},
+	
 	// Gérer l'événement de scan du code-barres via le champ scan_barcode
 	scan_barcode: function(frm) {
 		let scan_barcode_field = frm.fields_dict["scan_barcode"];
@@ -98,39 +106,184 @@ function calculer_quantite_restante(frm, cdt, cdn) {
 	frappe.model.set_value(cdt, cdn, 'statut_article', nouveau_statut);
 }
 
+// Session d'emballage : les scans sont regroupés puis envoyés par lots au serveur
+const PACKING_FLUSH_DELAY = 3000;	// ms sans nouveau scan avant envoi du lot
+const PACKING_FLUSH_SIZE = 20;		// nombre de scans déclenchant un envoi immédiat
+
 /**
- * Traite un code-barres d'article scanné et ajoute l'article correspondant à la table enfant 'articles'
+ * Traite un code-barres d'article scanné.
+ * Sur un colis déjà enregistré, le scan est mis en tampon et la quantité est
+ * incrémentée localement si l'article est déjà connu ; le lot est ensuite
+ * envoyé au serveur en une seule sauvegarde (voir envoyer_scans).
  * @param {Object} frm - L'objet formulaire Frappe
  * @param {String} code_barre - Le code-barres de l'article scanné
  */
 function traiter_article_scanne(frm, code_barre) {
-	// Utiliser la méthode serveur pour récupérer l'article à partir du code-barres
+	if (frm.is_new()) {
+		ajouter_article_local(frm, code_barre);
+		return;
+	}
+
+	const session = get_packing_session(frm);
+	session.buffer[code_barre] = (session.buffer[code_barre] || 0) + 1;
+	session.count += 1;
+
+	const article = session.articles[code_barre];
+	if (article) {
+		incrementer_article_local(frm, article);
+	}
+
+	clearTimeout(session.timer);
+	if (session.count >= PACKING_FLUSH_SIZE) {
+		envoyer_scans(frm);
+	} else {
+		session.timer = setTimeout(() => envoyer_scans(frm), PACKING_FLUSH_DELAY);
+	}
+}
+
+/**
+ * Retourne la session d'emballage du colis affiché (une par document)
+ * @param {Object} frm - L'objet formulaire Frappe
+ */
+function get_packing_session(frm) {
+	if (!frm.packing_session || frm.packing_session.docname !== frm.doc.name) {
+		frm.packing_session = {
+			docname: frm.doc.name,
+			buffer: {},		// code-barres -> nombre de scans en attente d'envoi
+			count: 0,
+			articles: {},	// code-barres -> article déjà résolu
+			timer: null,
+			in_flight: null
+		};
+	}
+	return frm.packing_session;
+}
+
+/**
+ * Envoie au serveur les scans en attente, en un seul appel
+ * @param {Object} frm - L'objet formulaire Frappe
+ * @returns {Promise} Résolue une fois le lot enregistré et la table des articles rafraîchie
+ */
+function envoyer_scans(frm) {
+	const session = get_packing_session(frm);
+	clearTimeout(session.timer);
+	if (session.in_flight) {
+		// Attendre l'envoi en cours, puis envoyer les scans arrivés entre-temps
+		return session.in_flight.then(() => envoyer_scans(frm));
+	}
+	if (!session.count) {
+		return Promise.resolve();
+	}
+
+	const scans = session.buffer;
+	session.buffer = {};
+	session.count = 0;
+
+	session.in_flight = new Promise(resolve => {
+		frappe.call({
+			method: 'log.log.doctype.colis.colis.append_scanned_articles',
+			args: {
+				docname: session.docname,
+				scans: scans
+			},
+			callback: function(r) {
+				const result = r.message || {};
+				Object.assign(session.articles, result.items || {});
+
+				if (result.success) {
+					frappe.show_alert({ message: __(result.message), indicator: 'green' }, 3);
+				}
+				(result.rejected || []).forEach(rejet => {
+					frappe.show_alert({ message: __(rejet.message), indicator: 'red' }, 5);
+				});
+			},
+			always: resolve
+		});
+	}).then(() => {
+		if (frm.doc.name !== session.docname) {
+			return;
+		}
+		return rafraichir_articles(frm).then(() => {
+			// Réappliquer localement les scans arrivés pendant l'envoi
+			Object.entries(session.buffer).forEach(([code_barre, count]) => {
+				const article = session.articles[code_barre];
+				for (let i = 0; article && i < count; i++) {
+					incrementer_article_local(frm, article);
+				}
+			});
+			if (session.count) {
+				session.timer = setTimeout(() => envoyer_scans(frm), PACKING_FLUSH_DELAY);
+			}
+		});
+	}).finally(() => {
+		session.in_flight = null;
+	});
+
+	return session.in_flight;
+}
+
+/**
+ * Envoie tous les scans en attente, y compris ceux arrivés pendant les envois
+ * @param {Object} frm - L'objet formulaire Frappe
+ * @returns {Promise} Résolue lorsqu'il ne reste plus aucun scan à enregistrer
+ */
+function vider_scans(frm) {
+	const session = get_packing_session(frm);
+	if (session.in_flight || session.count) {
+		return envoyer_scans(frm).then(() => vider_scans(frm));
+	}
+	return Promise.resolve();
+}
+
+/**
+ * Remplace la table des articles et la date de modification par celles du serveur,
+ * sans toucher aux autres champs du formulaire (saisies non enregistrées conservées)
+ * @param {Object} frm - L'objet formulaire Frappe
+ */
+function rafraichir_articles(frm) {
+	return frappe.db.get_doc('Colis', frm.doc.name).then(server_doc => {
+		frappe.model.clear_table(frm.doc, 'articles');
+		frm.doc.articles = frappe.model.sync(server_doc.articles || []);
+		frm.doc.modified = server_doc.modified;
+		frm.refresh_field('articles');
+	});
+}
+
+/**
+ * Incrémente localement la quantité d'un article déjà présent dans la table
+ * @param {Object} frm - L'objet formulaire Frappe
+ * @param {Object} article - L'article (name, item_name)
+ */
+function incrementer_article_local(frm, article) {
+	const row = (frm.doc.articles || []).find(r => r.article === article.name);
+	if (!row) {
+		return;
+	}
+	row.quantite_totale = (row.quantite_totale || 0) + 1;
+	calculer_quantite_restante(frm, row.doctype, row.name);
+	frm.refresh_field('articles');
+}
+
+/**
+ * Ajoute un article scanné à un colis pas encore enregistré (sans sauvegarde)
+ * @param {Object} frm - L'objet formulaire Frappe
+ * @param {String} code_barre - Le code-barres de l'article scanné
+ */
+function ajouter_article_local(frm, code_barre) {
 	frappe.call({
-		method: 'intrapro_erp_distribution.intrapro_erp_distribution.doctype.colis.colis.get_item_from_barcode',
+		method: 'log.log.doctype.colis.colis.get_item_from_barcode',
 		args: {
 			barcode: code_barre
 		},
 		callback: function(r) {
 			if (r.message) {
 				const article = r.message;
-				
-				// Vérifier si l'article est déjà dans la table
-				let existe = false;
-				let row_idx = null;
-				
-				$.each(frm.doc.articles || [], function(i, row) {
-					if (row.article === article.name) {
-						existe = true;
-						row_idx = i;
-						return false; // Sortir de la boucle
-					}
-				});
-				
-				if (existe) {
+				const row = (frm.doc.articles || []).find(r => r.article === article.name);
+
+				if (row) {
 					// Incrémenter la quantité si l'article existe déjà
-					frm.doc.articles[row_idx].quantite_totale += 1;
-					// Utiliser la fonction pour calculer la quantité restante
-					calculer_quantite_restante(frm, 'Articles Colis', frm.doc.articles[row_idx].name);
+					row.quantite_totale += 1;
+					calculer_quantite_restante(frm, 'Articles Colis', row.name);
 				} else {
 					// Ajouter un nouvel article à la table
 					const child = frm.add_child('articles');
@@ -140,18 +293,12 @@ function traiter_article_scanne(frm, code_barre) {
 					child.quantite_restante = 1;
 					child.statut_article = "En attente";
 				}
-				
-				// Rafraîchir la table
+
 				frm.refresh_field('articles');
-				
-				// Sauvegarder le document après l'ajout de l'article
-				frm.save().then(() => {
-					// Afficher un message de confirmation
-					frappe.show_alert({
-						message: __('Article {0} ajouté', [article.item_name || article.name]),
-						indicator: 'green'
-					}, 3);
-				});
+				frappe.show_alert({
+					message: __('Article {0} ajouté', [article.item_name || article.name]),
+					indicator: 'green'
+				}, 3);
 			} else {
 				// Aucun article trouvé avec ce code-barres
 				frappe.show_alert({
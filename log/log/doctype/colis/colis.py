@@ -3,171 +3,64 @@
 
 import frappe
 from frappe.model.document import Document
-import qrcode
-import io
-import base64
+
+from log import colis_delivery
+from log.colis_delivery import compute_global_status
+from log.colis_info import clear_colis_info_cache, get_cached_colis_info
+from log.colis_realtime import get_changed_articles, publish_colis_changes
+from log.delivery_note_hooks import get_delivery_note_quantities, get_packed_quantities, lock_delivery_note
+from log.delivery_note_sync import schedule_delivery_note_sync
+from log.item_barcode import resolve_barcode, resolve_barcodes
+from log.log.doctype.articles_colis.articles_colis import compute_quantite_restante, compute_statut_article
+from log.qr_code import ensure_qr_code, is_qr_code_current, render_qr_png
 
 
 class Colis(Document):
 	def validate(self):
-		# Générer le QR code à chaque sauvegarde
-		self.generate_qr_code()
 		# Calculer le statut global basé sur les articles
 		self.calculate_global_status()
 	
 	def on_update(self):
 		"""Hook appelé après la mise à jour du document"""
+		# Le QR code n'est régénéré (en arrière-plan) que si son contenu a changé
+		ensure_qr_code(self)
+		clear_colis_info_cache(self.name)
 		self.sync_with_delivery_note()
+		self.publish_changes()
+	
+	def publish_changes(self):
+		"""Diffuse en temps réel le statut et les seuls articles modifiés par la sauvegarde"""
+		articles = get_changed_articles(self)
+		if articles or self.has_value_changed("status"):
+			publish_colis_changes([{"name": self.name, "bl": self.bl, "status": self.status, "articles": articles}])
+	
+	def on_trash(self):
+		clear_colis_info_cache(self.name)
 	
 	def sync_with_delivery_note(self):
-		"""Synchronise les quantités livrées avec le Delivery Note associé"""
+		"""Programme la synchronisation des quantités livrées avec le Delivery Note associé"""
 		if not self.bl or not self.articles:
 			return
 		
-		try:
-			# Récupérer le Delivery Note
-			delivery_note = frappe.get_doc("Delivery Note", self.bl)
-			
-			# Créer un dictionnaire des quantités livrées par article
-			delivered_quantities = {}
-			for article in self.articles:
-				if article.article and article.quantite_livree > 0:
-					if article.article in delivered_quantities:
-						delivered_quantities[article.article] += article.quantite_livree
-					else:
-						delivered_quantities[article.article] = article.quantite_livree
-			
-			# Mettre à jour les quantités dans le Delivery Note
-			for item in delivery_note.items:
-				if item.item_code in delivered_quantities:
-					# Calculer la nouvelle quantité livrée
-					new_delivered_qty = delivered_quantities[item.item_code]
-					
-					# S'assurer que la quantité livrée ne dépasse pas la quantité commandée
-					if new_delivered_qty > item.qty:
-						new_delivered_qty = item.qty
-					
-					# Mettre à jour le champ delivered_qty s'il existe
-					if hasattr(item, 'delivered_qty'):
-						item.delivered_qty = new_delivered_qty
-			
-			# Sauvegarder le Delivery Note avec les nouvelles quantités
-			delivery_note.save(ignore_permissions=True)
-			
-			frappe.logger().info(f"Synchronisation réussie avec Delivery Note {self.bl}")
-			
-		except Exception as e:
-			frappe.logger().error(f"Erreur lors de la synchronisation avec Delivery Note {self.bl}: {str(e)}")
-			# Ne pas lever l'erreur pour éviter de bloquer la sauvegarde du Colis
+		schedule_delivery_note_sync(self.bl)
 	
 	def calculate_global_status(self):
 		"""Calcule automatiquement le statut global du colis basé sur les statuts des articles"""
 		if not self.articles:
 			return
 		
-		# Compter les statuts des articles
-		article_statuses = [article.statut_article for article in self.articles if article.statut_article]
-		
-		if not article_statuses:
-			return
-		
-		# Logique de calcul du statut global
-		if all(status == "Livré" for status in article_statuses):
-			self.status = "Livré"
-		elif all(status == "En attente" for status in article_statuses):
-			# Garder le statut actuel si tous les articles sont en attente
-			pass
-		elif any(status == "Partiellement livré" for status in article_statuses) or \
-			 (any(status == "Livré" for status in article_statuses) and 
-			  any(status in ["En attente", "Partiellement livré"] for status in article_statuses)):
-			self.status = "Partiellement Livré"
-		elif all(status == "Non livré" for status in article_statuses):
-			self.status = "Non Livré"
+		self.status = compute_global_status(
+			[article.statut_article for article in self.articles], self.status
+		)
 	
 	@frappe.whitelist()
 	def generate_qr_code(self):
-		"""Génère un QR code pour le document Colis et le stocke directement comme pièce jointe"""
-		if not self.name or self.name == "new-colis":
+		"""Génère immédiatement le QR code du colis s'il ne correspond plus à son contenu"""
+		if not self.name or self.name == "new-colis" or is_qr_code_current(self):
 			return
-		
-		# Construire l'URL complète vers l'interface livreurs
-		site_url = frappe.utils.get_url()
-		frontend_url = f"{site_url}/frontend/colis/{self.name}"
-		
-		# URL vers l'application Frappe (pour les utilisateurs authentifiés)
-		app_url = f"{site_url}/app/colis/{self.name}"
-		
-		# Préparer les données à encoder dans le QR code
-		# Format JSON pour inclure plus d'informations
-		qr_data = {
-			"id": self.name,
-			"url": frontend_url,  # URL de l'interface livreurs pour accès direct
-			"app_url": app_url,  # URL de l'application pour les utilisateurs authentifiés
-			"client": self.client if self.client else "",
-			"date": str(self.date) if self.date else "",
-			"status": self.status if self.status else ""
-		}
-		
-		# Pour les scanners QR simples qui ne supportent que les URL, utiliser directement l'URL de l'interface livreurs
-		data = frontend_url
-		
-		# Créer le QR code avec des paramètres optimisés pour réduire la taille
-		# Augmenter légèrement la version pour accommoder plus de données
-		qr = qrcode.QRCode(
-			version=4,  # Version plus élevée pour plus de données
-			error_correction=qrcode.constants.ERROR_CORRECT_M,
-			box_size=6,
-			border=2,
-		)
-		qr.add_data(data)
-		qr.make(fit=True)
-		
-		# Créer l'image
-		img = qr.make_image(fill_color="black", back_color="white")
-		
-		# Préparer le buffer pour l'image
-		buffer = io.BytesIO()
-		img.save(buffer, format="PNG", optimize=True)  # Optimiser l'image PNG
-		buffer.seek(0)
-		
-		# Nom du fichier QR code
-		file_name = f"qr_code_{self.name}.png"
-		
-		# Supprimer les anciennes pièces jointes de QR code si elles existent
-		existing_files = frappe.get_all(
-			"File",
-			filters={
-				"attached_to_doctype": "Colis",
-				"attached_to_name": self.name,
-				"file_name": ["like", "qr_code_%"]
-			},
-			fields=["name"]
-		)
-		
-		for file in existing_files:
-			try:
-				frappe.delete_doc("File", file.name)
-			except Exception as e:
-				frappe.log_error(f"Erreur lors de la suppression du fichier QR code: {e}")
-		
-		# Sauvegarder comme pièce jointe
-		file_doc = frappe.get_doc({
-			"doctype": "File",
-			"file_name": file_name,
-			"attached_to_doctype": "Colis",
-			"attached_to_name": self.name,
-			"content": buffer.getvalue(),
-			"is_private": 0
-		})
-		
-		# Insérer le nouveau fichier et récupérer l'URL
-		file_url = file_doc.insert().file_url
-		
-		# Mettre à jour le champ image
-		self.image = file_url
-		
-		# Ne plus utiliser le champ qr_code pour éviter l'erreur "Valeur trop grande"
-		self.qr_code = None
+
+		ensure_qr_code(self, now=True)
+		self.db_set("image", self.image, update_modified=False)
 
 
 @frappe.whitelist()
@@ -180,30 +73,109 @@ def get_item_from_barcode(barcode):
 	Returns:
 		dict: Les informations de l'article (name, item_name) ou None si non trouvé
 	"""
-	# Sauvegarder les permissions actuelles
-	original_flags = {}
-	if hasattr(frappe.local, 'flags'):
-		original_flags = dict(frappe.local.flags)
+	return resolve_barcode(barcode)
+
+
+@frappe.whitelist()
+def get_items_from_barcodes(barcodes):
+	"""Récupère les articles correspondant à plusieurs codes-barres en un seul appel
 	
-	try:
-		# Désactiver la vérification des permissions
-		frappe.flags.ignore_permissions = True
-		
-		# Rechercher le code-barres dans Item Barcode
-		parent = frappe.db.get_value("Item Barcode", {"barcode": barcode}, "parent")
-		
-		if parent:
-			# Récupérer les détails de l'article
-			item = frappe.db.get_value("Item", parent, ["name", "item_name"], as_dict=True)
-			return item
-		
-		return None
-	finally:
-		# Restaurer les permissions originales
-		if original_flags:
-			frappe.local.flags = frappe._dict(original_flags)
-		else:
-			frappe.flags.ignore_permissions = False
+	Args:
+		barcodes (list): Les codes-barres à rechercher (liste ou JSON)
+	
+	Returns:
+		dict: {code-barres: informations de l'article (name, item_name) ou None}
+	"""
+	if isinstance(barcodes, str):
+		barcodes = frappe.parse_json(barcodes)
+	
+	return resolve_barcodes(barcodes)
+
+
+@frappe.whitelist()
+def append_scanned_articles(docname, scans):
+	"""Ajoute au colis un lot d'articles scannés, en une seule sauvegarde
+	
+	Les quantités sont contrôlées une fois pour tout le lot contre les
+	quantités restantes de la DN ; l'excédent est refusé et signalé.
+	
+	Args:
+		docname (str): Le nom du document Colis
+		scans (dict): {code-barres: nombre de scans} (dict ou JSON)
+	
+	Returns:
+		dict: Articles ajoutés, scans refusés et résolution des codes-barres (`items`)
+	"""
+	if isinstance(scans, str):
+		scans = frappe.parse_json(scans)
+	scans = scans or {}
+	
+	# Verrouiller le colis avant la DN, dans le même ordre qu'une sauvegarde
+	# ordinaire (check_if_latest puis validate_colis_quantities)
+	doc = frappe.get_doc("Colis", docname, for_update=True)
+	doc.check_permission("write")
+	
+	items = resolve_barcodes(list(scans))
+	
+	requested = {}
+	rejected = []
+	for barcode, count in scans.items():
+		count = frappe.utils.cint(count)
+		if count <= 0:
+			continue
+		item = items.get(barcode)
+		if not item:
+			rejected.append({'barcode': barcode, 'qty': count, 'message': f'Aucun article trouvé avec le code-barres: {barcode}'})
+			continue
+		requested[item.name] = requested.get(item.name, 0) + count
+	
+	current = {}
+	for row in doc.articles:
+		current[row.article] = current.get(row.article, 0) + (row.quantite_totale or 0)
+	
+	if doc.bl:
+		lock_delivery_note(doc.bl)
+		dn_qty = get_delivery_note_quantities(doc.bl)
+		packed = get_packed_quantities(doc.bl, exclude_colis=doc.name, locking_read=True)
+	
+	accepted = {}
+	for code, qty in requested.items():
+		if doc.bl:
+			available = dn_qty.get(code, {}).get("qty", 0) - packed.get(code, 0) - current.get(code, 0)
+			if qty > available:
+				rejected.append({
+					'item_code': code,
+					'qty': qty - max(available, 0),
+					'message': f'Quantité trop élevée pour l\'article « {code} » : {max(available, 0)} restant(s) sur la DN'
+				})
+				qty = available
+		if qty > 0:
+			accepted[code] = qty
+	
+	for code, qty in accepted.items():
+		row = next((r for r in doc.articles if r.article == code), None)
+		if not row:
+			row = doc.append("articles", {
+				"article": code,
+				"quantite_totale": 0,
+				"quantite_livree": 0
+			})
+		row.quantite_totale = (row.quantite_totale or 0) + qty
+		row.quantite_restante = compute_quantite_restante(row.quantite_totale, row.quantite_livree)
+		row.statut_article = compute_statut_article(row.quantite_totale, row.quantite_livree)
+	
+	if accepted:
+		# Les quantités viennent d'être contrôlées contre la DN pour tout le lot
+		doc.flags.colis_quantities_validated = True
+		doc.save()
+	
+	return {
+		'success': bool(accepted),
+		'message': f'{sum(accepted.values())} article(s) ajouté(s)' if accepted else 'Aucun article ajouté',
+		'added': accepted,
+		'rejected': rejected,
+		'items': {barcode: item for barcode, item in items.items() if item}
+	}
 
 
 def get_allowed_transitions():
@@ -253,8 +225,50 @@ def get_available_actions(docname):
 	Returns:
 		dict: Actions disponibles et informations sur le statut
 	"""
-	doc = frappe.get_doc("Colis", docname)
-	current_status = doc.status
+	doc = frappe.db.get_value("Colis", docname, ["name", "status"], as_dict=True)
+	if not doc:
+		frappe.throw(f"Colis {docname} introuvable", frappe.DoesNotExistError)
+	
+	return build_available_actions(doc.status)
+
+
+@frappe.whitelist()
+def get_available_actions_bulk(docnames):
+	"""Retourne les actions disponibles pour plusieurs colis en une seule requête
+	
+	Args:
+		docnames (list): Les noms des documents Colis (liste ou JSON)
+	
+	Returns:
+		dict: Actions disponibles par nom de colis (les colis introuvables sont omis)
+	"""
+	if isinstance(docnames, str):
+		docnames = frappe.parse_json(docnames)
+	if not docnames:
+		return {}
+	
+	rows = frappe.get_all("Colis", filters={"name": ["in", docnames]}, fields=["name", "status"])
+	
+	# Les colis d'un même statut partagent la même matrice d'actions
+	actions_by_status = {}
+	result = {}
+	for row in rows:
+		if row.status not in actions_by_status:
+			actions_by_status[row.status] = build_available_actions(row.status)
+		result[row.name] = actions_by_status[row.status]
+	
+	return result
+
+
+def build_available_actions(current_status):
+	"""Construit la matrice des actions disponibles pour un statut de colis
+	
+	Args:
+		current_status (str): Le statut du colis
+	
+	Returns:
+		dict: Actions disponibles et informations sur le statut
+	"""
 	allowed_transitions = get_allowed_transitions()
 	
 	# Actions de statut disponibles
@@ -521,6 +535,112 @@ def set_status_not_delivered(docname, confirm=False):
 	}
 
 
+@frappe.whitelist()
+def set_status_bulk(docnames, status, confirm=False):
+	"""Applique un même changement de statut à plusieurs colis
+	
+	Toutes les transitions sont validées en une passe ; les colis valides
+	sont mis à jour par un seul UPDATE dans la transaction de la requête.
+	
+	Args:
+		docnames (list): Les noms des documents Colis (liste ou JSON)
+		status (str): Le statut cible
+		confirm (bool): Confirmation de l'utilisateur
+	
+	Returns:
+		dict: Résultat global et détail par colis (`results`)
+	"""
+	if isinstance(docnames, str):
+		docnames = frappe.parse_json(docnames)
+	docnames = list(dict.fromkeys(docnames or []))
+	confirm = frappe.utils.cint(confirm)
+	
+	if status not in get_allowed_transitions():
+		return {
+			'success': False,
+			'message': f"Statut '{status}' non reconnu"
+		}
+	
+	if not docnames:
+		return {
+			'success': False,
+			'message': 'Aucun colis sélectionné'
+		}
+	
+	frappe.has_permission("Colis", "write", throw=True)
+	
+	# Permissions au niveau des documents (permissions utilisateur, propriétaire,
+	# conditions de requête) en une seule requête, sans charger chaque colis
+	permitted = set(frappe.get_list("Colis", filters={"name": ["in", docnames]}, pluck="name", limit_page_length=0))
+	
+	# Verrouiller les lignes seulement lorsque la transition est appliquée
+	current = {
+		row.name: row
+		for row in frappe.db.sql(
+			f"""
+			SELECT name, status, bl
+			FROM `tabColis`
+			WHERE name IN %s
+			ORDER BY name
+			{"FOR UPDATE" if confirm else ""}
+			""",
+			(tuple(docnames),),
+			as_dict=True
+		)
+	}
+	
+	results = []
+	valid_names = []
+	for name in docnames:
+		if name not in current:
+			results.append({'name': name, 'success': False, 'message': 'Colis non trouvé'})
+			continue
+		
+		if name not in permitted:
+			results.append({'name': name, 'success': False, 'message': 'Permission refusée sur ce colis'})
+			continue
+		
+		previous_status = current[name].status
+		is_valid, error_msg = validate_status_transition(previous_status, status)
+		if not is_valid:
+			results.append({'name': name, 'success': False, 'message': error_msg, 'previous_status': previous_status})
+			continue
+		
+		valid_names.append(name)
+		results.append({
+			'name': name,
+			'success': True,
+			'previous_status': previous_status,
+			'new_status': status
+		})
+	
+	if not confirm:
+		return {
+			'success': False,
+			'require_confirmation': True,
+			'message': f'Êtes-vous sûr de vouloir passer {len(valid_names)} colis au statut "{status}" ?'
+				+ (f' ({len(docnames) - len(valid_names)} colis ignoré(s))' if len(valid_names) < len(docnames) else ''),
+			'results': results
+		}
+	
+	if valid_names:
+		frappe.db.sql("""
+			UPDATE `tabColis`
+			SET status = %s, modified = %s, modified_by = %s
+			WHERE name IN %s
+		""", (status, frappe.utils.now_datetime(), frappe.session.user, tuple(valid_names)))
+		clear_colis_info_cache(valid_names)
+		publish_colis_changes([{"name": name, "bl": current[name].bl, "status": status} for name in valid_names])
+	
+	return {
+		'success': bool(valid_names),
+		'message': f'{len(valid_names)} colis mis à jour vers "{status}"'
+			+ (f', {len(docnames) - len(valid_names)} en échec' if len(valid_names) < len(docnames) else ''),
+		'updated_count': len(valid_names),
+		'results': results
+	}
+
+
 @frappe.whitelist()
 def download_qr_code(docname):
 	"""Télécharge le QR code existant d'un colis ou en génère un nouveau si nécessaire
@@ -555,26 +675,8 @@ def download_qr_code(docname):
 	site_url = frappe.utils.get_url()
 	public_url = f"{site_url}/colis_info?id={doc.name}"
 	
-	# Créer le QR code avec les mêmes paramètres optimisés que dans generate_qr_code
-	qr = qrcode.QRCode(
-		version=4,  # Version plus élevée pour plus de données
-		error_correction=qrcode.constants.ERROR_CORRECT_M,
-		box_size=6,
-		border=2,
-	)
-	qr.add_data(public_url)  # Utiliser l'URL publique directement
-	qr.make(fit=True)
-	
-	# Créer l'image
-	img = qr.make_image(fill_color="black", back_color="white")
-	
-	# Préparer le buffer pour le téléchargement
-	buffer = io.BytesIO()
-	img.save(buffer, format="PNG", optimize=True)  # Optimiser l'image PNG
-	buffer.seek(0)
-	
 	# Renvoyer le fichier pour téléchargement
-	frappe.response['filecontent'] = buffer.getvalue()
+	frappe.response['filecontent'] = render_qr_png(public_url)
 	frappe.response['filename'] = f"qr_code_{doc.name}.png"
 	frappe.response['type'] = 'download'
 
@@ -601,58 +703,18 @@ def deliver_article_quantity(docname, article_name, quantity, confirm=False):
 	
 	try:
 		quantity = int(quantity)
-		if quantity <= 0:
-			return {
-				'success': False,
-				'message': 'La quantité doit être positive'
-			}
-		
-		# Récupérer le document colis
-		colis_doc = frappe.get_doc("Colis", docname)
-		
-		# Trouver l'article dans la table
-		article_doc = None
-		for article in colis_doc.articles:
-			if article.name == article_name:
-				article_doc = frappe.get_doc("Articles Colis", article.name)
-				break
-		
-		if not article_doc:
-			return {
-				'success': False,
-				'message': 'Article non trouvé'
-			}
-		
-		# Utiliser la méthode de livraison de l'article
-		result = article_doc.deliver_quantity(quantity)
-		
-		# Recharger le document colis pour récupérer les modifications
-		colis_doc.reload()
-		
-		# Recalculer le statut global du colis
-		colis_doc.calculate_global_status()
-		colis_doc.save()
-		
-		# Forcer la validation et sauvegarde du document parent
-		frappe.db.commit()
-		
-		# Ajouter les données complètes de l'article pour la mise à jour de l'interface
-		if result.get('success'):
-			result['article_data'] = {
-				'quantite_totale': article_doc.quantite_totale,
-				'quantite_livree': article_doc.quantite_livree,
-				'quantite_restante': article_doc.quantite_restante,
-				'statut_article': article_doc.statut_article
-			}
-		
-		return result
-		
-	except Exception as e:
-		frappe.log_error(f"Erreur lors de la livraison partielle: {e}")
+	except (TypeError, ValueError):
+		quantity = 0
+	if quantity <= 0:
 		return {
 			'success': False,
-			'message': f'Erreur: {str(e)}'
+			'message': 'La quantité doit être positive'
 		}
+	
+	return _run_article_delivery(
+		"Erreur lors de la livraison partielle",
+		colis_delivery.deliver_quantity, docname, article_name, quantity
+	)
 
 
 @frappe.whitelist()
@@ -674,53 +736,10 @@ def deliver_article_remaining(docname, article_name, confirm=False):
 			'message': 'Êtes-vous sûr de vouloir livrer toute la quantité restante de cet article ?'
 		}
 	
-	try:
-		# Récupérer le document colis
-		colis_doc = frappe.get_doc("Colis", docname)
-		
-		# Trouver l'article dans la table
-		article_doc = None
-		for article in colis_doc.articles:
-			if article.name == article_name:
-				article_doc = frappe.get_doc("Articles Colis", article.name)
-				break
-		
-		if not article_doc:
-			return {
-				'success': False,
-				'message': 'Article non trouvé'
-			}
-		
-		# Utiliser la méthode de livraison complète de l'article
-		result = article_doc.deliver_remaining()
-		
-		# Recharger le document colis pour récupérer les modifications
-		colis_doc.reload()
-		
-		# Recalculer le statut global du colis
-		colis_doc.calculate_global_status()
-		colis_doc.save()
-		
-		# Forcer la validation et sauvegarde du document parent
-		frappe.db.commit()
-		
-		# Ajouter les données complètes de l'article pour la mise à jour de l'interface
-		if result.get('success'):
-			result['article_data'] = {
-				'quantite_totale': article_doc.quantite_totale,
-				'quantite_livree': article_doc.quantite_livree,
-				'quantite_restante': article_doc.quantite_restante,
-				'statut_article': article_doc.statut_article
-			}
-		
-		return result
-		
-	except Exception as e:
-		frappe.log_error(f"Erreur lors de la livraison complète: {e}")
-		return {
-			'success': False,
-			'message': f'Erreur: {str(e)}'
-		}
+	return _run_article_delivery(
+		"Erreur lors de la livraison complète",
+		colis_delivery.deliver_remaining, docname, article_name
+	)
 
 
 @frappe.whitelist()
@@ -743,49 +762,29 @@ def mark_article_undeliverable(docname, article_name, reason="", confirm=False):
 			'message': 'Êtes-vous sûr de vouloir marquer cet article comme non livrable ?'
 		}
 	
+	return _run_article_delivery(
+		"Erreur lors du marquage non livrable",
+		colis_delivery.mark_undeliverable, docname, article_name, reason
+	)
+
+
+def _run_article_delivery(error_title, operation, docname, *args):
+	"""Exécute une opération de livraison dans un point de sauvegarde
+	
+	Les modifications sont annulées si l'opération échoue ; sinon elles sont
+	validées avec le reste de la requête.
+	"""
+	frappe.db.savepoint("colis_delivery")
 	try:
-		# Récupérer le document colis
-		colis_doc = frappe.get_doc("Colis", docname)
-		
-		# Trouver l'article dans la table
-		article_doc = None
-		for article in colis_doc.articles:
-			if article.name == article_name:
-				article_doc = frappe.get_doc("Articles Colis", article.name)
-				break
-		
-		if not article_doc:
-			return {
-				'success': False,
-				'message': 'Article non trouvé'
-			}
-		
-		# Marquer l'article comme non livrable
-		result = article_doc.mark_as_undeliverable(reason)
-		
-		# Recharger le document colis pour récupérer les modifications
-		colis_doc.reload()
-		
-		# Recalculer le statut global du colis
-		colis_doc.calculate_global_status()
-		colis_doc.save()
-		
-		# Forcer la validation et sauvegarde du document parent
-		frappe.db.commit()
-		
-		# Ajouter les données complètes de l'article pour la mise à jour de l'interface
-		if result.get('success'):
-			result['article_data'] = {
-				'quantite_totale': article_doc.quantite_totale,
-				'quantite_livree': article_doc.quantite_livree,
-				'quantite_restante': article_doc.quantite_restante,
-				'statut_article': article_doc.statut_article
-			}
-		
-		return result
-		
+		# Permission sur le colis lui-même (permissions utilisateur, propriétaire),
+		# comme le faisait la sauvegarde du document ; un colis introuvable ou
+		# refusé donne le même résultat structuré qu'un échec de livraison
+		frappe.has_permission("Colis", "write", doc=docname, throw=True)
+		return operation(docname, *args)
 	except Exception as e:
-		frappe.log_error(f"Erreur lors du marquage non livrable: {e}")
+		frappe.db.rollback(save_point="colis_delivery")
+		if not isinstance(e, (frappe.ValidationError, frappe.PermissionError)):
+			frappe.log_error(f"{error_title}: {e}")
 		return {
 			'success': False,
 			'message': f'Erreur: {str(e)}'
@@ -796,37 +795,7 @@ def mark_article_undeliverable(docname, article_name, reason="", confirm=False):
 def get_colis_info(colis_id):
 	"""Méthode publique pour récupérer les informations d'un colis"""
 	try:
-		# Récupérer le document colis
-		colis = frappe.get_doc("Colis", colis_id)
-		
-		# Préparer les données de base
-		data = {
-			"name": colis.name,
-			"status": colis.status,
-			"client": colis.client,
-			"bl": colis.bl,
-			"date_creation": colis.creation,
-			"articles": []
-		}
-		
-		# Ajouter les articles
-		for article in colis.articles:
-			# Récupérer les détails de l'article depuis le doctype Item
-			item_doc = frappe.get_doc("Item", article.article)
-			
-			article_data = {
-				"name": article.name,
-				"article": article.article,
-				"item_name": item_doc.item_name,
-				"quantite_totale": article.quantite_totale,
-				"quantite_livree": article.quantite_livree,
-				"quantite_restante": article.quantite_restante,
-				"statut_article": article.statut_article
-			}
-			data["articles"].append(article_data)
-		
-		return data
-		
+		return get_cached_colis_info(colis_id)
 	except frappe.DoesNotExistError:
 		return {"error": "Colis non trouvé"}
 	except Exception as e:
@@ -852,52 +821,7 @@ def deliver_all_articles(docname, confirm=False):
 			'message': 'Êtes-vous sûr de vouloir livrer tous les articles restants ?'
 		}
 	
-	try:
-		# Récupérer le document colis
-		colis_doc = frappe.get_doc("Colis", docname)
-		
-		# Compter les articles livrables
-		articles_livres = 0
-		articles_total = 0
-		
-		# Livrer tous les articles qui peuvent l'être
-		for article in colis_doc.articles:
-			article_doc = frappe.get_doc("Articles Colis", article.name)
-			articles_total += 1
-			
-			# Vérifier si l'article peut être livré (quantité restante > 0 et statut approprié)
-			if (article_doc.quantite_restante > 0 and 
-				article_doc.statut_article in ['En Attente', 'Partiellement Livré']):
-				
-				# Livrer la quantité restante
-				result = article_doc.deliver_remaining()
-				if result.get('success'):
-					articles_livres += 1
-		
-		# Recharger le document colis pour récupérer les modifications
-		colis_doc.reload()
-		
-		# Recalculer le statut global du colis
-		colis_doc.calculate_global_status()
-		colis_doc.save()
-		
-		# Forcer la validation et sauvegarde du document parent
-		frappe.db.commit()
-		
-		if articles_livres > 0:
-			return {
-				'success': True,
-				'message': f'{articles_livres} article(s) livré(s) avec succès'
-			}
-		else:
-			return {
-				'success': False,
-				'message': 'Aucun article à livrer'
-			}
-		
-	except Exception as e:
-		frappe.log_error(f"Erreur lors de la livraison de tous les articles: {e}")
-		return {
-			'success': False,
-			'message': f'Erreur: {str(e)}'
-		}
+	return _run_article_delivery(
+		"Erreur lors de la livraison de tous les articles",
+		colis_delivery.deliver_all, docname
+	)
@@ -4,6 +4,16 @@
 # import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from log.colis_delivery import compute_global_status
+
 
 class TestColis(FrappeTestCase):
-	pass
+	def test_global_status_from_articles(self):
+		self.assertEqual(compute_global_status(["Livré", "Livré"], "Enlevé"), "Livré")
+		self.assertEqual(compute_global_status(["Livré", "En attente"], "Enlevé"), "Partiellement Livré")
+		self.assertEqual(compute_global_status(["Partiellement livré"], "Enlevé"), "Partiellement Livré")
+		self.assertEqual(compute_global_status(["Non livré", "Non livré"], "Enlevé"), "Non Livré")
+
+	def test_global_status_kept_when_nothing_delivered(self):
+		self.assertEqual(compute_global_status(["En attente", "En attente"], "Préparé"), "Préparé")
+		self.assertEqual(compute_global_status([None], "Nouveau"), "Nouveau")
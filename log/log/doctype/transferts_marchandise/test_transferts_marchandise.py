@@ -4,6 +4,8 @@
 import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from log.log.doctype.transferts_marchandise.transferts_marchandise import split_into_chunks
+
 
 class TestTransfertsMarchandise(FrappeTestCase):
     @classmethod
@@ -126,3 +128,35 @@ class TestTransfertsMarchandise(FrappeTestCase):
         self.assertEqual(len(stock_entry.items), 1)
         self.assertEqual(stock_entry.items[0].item_code, self.item.item_code)
         self.assertEqual(stock_entry.items[0].qty, 10)
+
+    def test_conflicting_delivery_notes_reported_together(self):
+        """Teste que tous les bons de livraison en conflit sont signalés dans un seul message."""
+        frappe.db.set_value("Delivery Note", self.delivery_note.name, "custom_préparé", 1)
+        self.addCleanup(frappe.db.set_value, "Delivery Note", self.delivery_note.name, "custom_préparé", 0)
+
+        transfert = frappe.get_doc({
+            "doctype": "Transferts Marchandise",
+            "from_warehouse": self.from_warehouse.name,
+            "to_warehouse": self.to_warehouse.name,
+            "delivery_notes": [
+                {"delivery_note": self.delivery_note.name},
+                {"delivery_note": self.delivery_note.name}
+            ]
+        })
+
+        with self.assertRaises(frappe.ValidationError) as context:
+            transfert.insert(ignore_permissions=True)
+
+        message = str(context.exception)
+        self.assertIn("déjà ajouté dans ce transfert", message)
+        self.assertIn("déjà marqué comme transféré", message)
+
+    def test_split_into_chunks(self):
+        """Teste le découpage des lignes consolidées en lots."""
+        items = [{"item_code": f"ITEM-{i}"} for i in range(5)]
+
+        chunks = split_into_chunks(items, 2)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(split_into_chunks(items, 0), [[item] for item in items])
+        self.assertEqual(split_into_chunks([], 2), [])
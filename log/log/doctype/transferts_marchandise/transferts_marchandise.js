@@ -2,7 +2,52 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('Transferts Marchandise', {
+    setup: function (frm) {
+        // Avancement du transfert de stock exécuté en arrière-plan
+        frappe.realtime.on('stock_transfer_progress', function (data) {
+            if (!data || data.transfert !== frm.doc.name) {
+                return;
+            }
+
+            if (data.error) {
+                frm.dashboard.hide_progress(__('Transfert de stock'));
+                frappe.msgprint({ title: __('Transfert de stock'), message: __(data.error), indicator: 'red' });
+                return;
+            }
+
+            frm.dashboard.show_progress(
+                __('Transfert de stock'),
+                data.total ? (data.done / data.total) * 100 : 100,
+                __('Lot {0} sur {1}', [data.done, data.total])
+            );
+
+            if (data.done === data.total) {
+                frm.dashboard.hide_progress(__('Transfert de stock'));
+                frappe.show_alert({
+                    message: __('Transfert de stock terminé : {0}', [data.stock_entries.join(', ')]),
+                    indicator: 'green'
+                });
+            }
+        });
+    },
+
     refresh: function (frm) {
+        if (frm.doc.docstatus === 1) {
+            // Transfert de stock en arrière-plan, découpé en lots pour les gros transferts
+            frm.add_custom_button(__('Transférer le stock'), function () {
+                frappe.call({
+                    method: 'log.log.doctype.transferts_marchandise.transferts_marchandise.enqueue_transfer_stock',
+                    args: { transfert_name: frm.doc.name },
+                    freeze: true,
+                    callback: function (r) {
+                        if (r.message && r.message.success) {
+                            frappe.show_alert({ message: __(r.message.message), indicator: 'blue' });
+                        }
+                    }
+                });
+            });
+        }
+
         // Ajoute un bouton pour actualiser les champs
         frm.add_custom_button(__('Actualiser les Champs'), function () {
             if (!frm.doc.delivery_notes || frm.doc.delivery_notes.length === 0) {
@@ -3,6 +3,14 @@
 
 import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, flt, now
+from frappe.utils.background_jobs import is_job_enqueued
+
+from log.utils import invalidate_documents
+
+# Nombre maximal de lignes par Stock Entry pour les transferts en arrière-plan
+# (surchargeable par `log_stock_transfer_chunk_size` dans site_config.json)
+DEFAULT_TRANSFER_CHUNK_SIZE = 200
 
 
 class TransfertsMarchandise(Document):
@@ -21,96 +29,112 @@ class TransfertsMarchandise(Document):
 
 
 def validate_delivery_notes(doc, method=None):
-    """Valide que les bons de livraison sont uniques dans le transfert."""
+    """Valide que les bons de livraison sont uniques dans le transfert.
+
+    Les contrôles en base portent sur toutes les lignes à la fois (deux requêtes)
+    et tous les bons en conflit sont signalés dans un seul message.
+    """
     if not doc.delivery_notes or len(doc.delivery_notes) == 0:
         frappe.throw("La table des bons de livraison ne peut pas être vide.")
 
     existing_delivery_notes = set()
+    errors = []
 
     for row in doc.delivery_notes:
         if not row.delivery_note:
             frappe.throw("Tous les bons de livraison doivent être renseignés.")
 
         if row.delivery_note in existing_delivery_notes:
-            frappe.throw(f"Le bon de livraison {row.delivery_note} est déjà ajouté dans ce transfert.")
+            errors.append(f"Le bon de livraison {row.delivery_note} est déjà ajouté dans ce transfert.")
 
-        # Vérifiez si ce bon de livraison est déjà lié à un autre transfert
-        linked_transfers = frappe.db.sql("""
-            SELECT parent
-            FROM `tabBons de Livraison Transferts`
-            WHERE delivery_note = %s AND parent != %s
-              AND parent IN (SELECT name FROM `tabTransferts Marchandise` WHERE docstatus < 2)
-        """, (row.delivery_note, doc.name))
+        existing_delivery_notes.add(row.delivery_note)
 
-        if linked_transfers:
-            frappe.throw(f"Le bon de livraison {row.delivery_note} est déjà lié au transfert {linked_transfers[0][0]}.")
+    delivery_notes = tuple(existing_delivery_notes)
 
-        # Vérifiez si le bon de livraison est déjà marqué comme transféré
-        prepared_status = frappe.db.get_value("Delivery Note", row.delivery_note, "custom_préparé")
-        if prepared_status:
-            frappe.throw(f"Le bon de livraison {row.delivery_note} est déjà marqué comme transféré vers préparation.")
+    # Bons de livraison déjà liés à un autre transfert non annulé
+    linked_transfers = frappe.db.sql("""
+        SELECT bt.delivery_note, bt.parent
+        FROM `tabBons de Livraison Transferts` bt
+        INNER JOIN `tabTransferts Marchandise` t ON t.name = bt.parent
+        WHERE bt.delivery_note IN %s AND bt.parent != %s
+          AND bt.parenttype = 'Transferts Marchandise'
+          AND t.docstatus < 2
+        ORDER BY bt.delivery_note
+    """, (delivery_notes, doc.name or ""))
 
-        existing_delivery_notes.add(row.delivery_note)
+    for delivery_note, transfer in linked_transfers:
+        errors.append(f"Le bon de livraison {delivery_note} est déjà lié au transfert {transfer}.")
+
+    # Bons de livraison déjà marqués comme transférés
+    prepared = frappe.get_all(
+        "Delivery Note",
+        filters={"name": ["in", delivery_notes], "custom_préparé": 1},
+        pluck="name",
+        order_by="name asc",
+    )
+
+    for delivery_note in prepared:
+        errors.append(f"Le bon de livraison {delivery_note} est déjà marqué comme transféré vers préparation.")
+
+    if errors:
+        frappe.throw("<br>".join(errors), title="Bons de livraison en conflit")
 
 
 def update_preparation_status(doc):
     """Marque les bons de livraison comme préparés lorsque le transfert est validé."""
-    for row in doc.delivery_notes:
-        frappe.db.set_value("Delivery Note", row.delivery_note, "custom_préparé", 1)
-        frappe.msgprint(f"Le bon de livraison {row.delivery_note} est marqué comme transféré vers préparation.")
+    count = set_preparation_status(doc, 1)
+    frappe.msgprint(f"{count} bon(s) de livraison marqué(s) comme transféré(s) vers préparation.")
 
 
 def reset_preparation_status(doc):
     """Réinitialise le statut préparé des bons de livraison lorsqu'un transfert est annulé."""
-    for row in doc.delivery_notes:
-        frappe.db.set_value("Delivery Note", row.delivery_note, "custom_préparé", 0)
-        frappe.msgprint(f"Le bon de livraison {row.delivery_note} est marqué comme non transféré vers préparation.")
+    count = set_preparation_status(doc, 0)
+    frappe.msgprint(f"{count} bon(s) de livraison marqué(s) comme non transféré(s) vers préparation.")
+
+
+def set_preparation_status(doc, value):
+    """Met à jour `custom_préparé` de tous les bons de livraison du transfert en un seul UPDATE.
+
+    Returns:
+        int: Le nombre de bons de livraison concernés
+    """
+    delivery_notes = list({row.delivery_note for row in doc.delivery_notes if row.delivery_note})
+    if not delivery_notes:
+        return 0
+
+    frappe.db.sql("""
+        UPDATE `tabDelivery Note`
+        SET `custom_préparé` = %(value)s, modified = %(now)s, modified_by = %(user)s
+        WHERE name IN %(names)s
+    """, {"value": value, "now": now(), "user": frappe.session.user, "names": tuple(delivery_notes)})
+
+    invalidate_documents("Delivery Note", delivery_notes)
+    return len(delivery_notes)
 
 
 def return_items_to_source(doc):
-    """Retourne les articles au dépôt d'origine après annulation."""
+    """Retourne au dépôt d'origine, après annulation, le stock effectivement transféré.
+
+    Les lignes du retour sont celles déplacées par les Stock Entry liés au
+    transfert : un transfert en arrière-plan non démarré ou interrompu ne
+    retourne que ses lots déjà soumis, et rien si aucun n'a été soumis.
+    """
     if not doc.delivery_notes:
         frappe.throw("Aucun bon de livraison dans ce transfert.")
 
-    # Préparez un dictionnaire pour consolider les articles
-    consolidated_items = {}
-
-    for row in doc.delivery_notes:
-        delivery_note = frappe.get_doc("Delivery Note", row.delivery_note)
-
-        for item in delivery_note.items:
-            item_key = (item.item_code, item.uom)
-            if item_key in consolidated_items:
-                consolidated_items[item_key]["qty"] += item.qty
-            else:
-                consolidated_items[item_key] = {
-                    "item_code": item.item_code,
-                    "qty": item.qty,
-                    "uom": item.uom,
-                    "stock_uom": item.stock_uom,
-                    "conversion_factor": item.conversion_factor,
-                    "basic_rate": item.rate,
-                }
-
-    # Génère un Stock Entry pour retourner les articles
-    stock_entry = frappe.new_doc("Stock Entry")
-    stock_entry.purpose = "Material Transfer"
-    stock_entry.from_warehouse = doc.to_warehouse  # Dépôt cible devient source
-    stock_entry.to_warehouse = doc.from_warehouse  # Retour au dépôt d'origine
-    stock_entry.items = [
-        {
-            "item_code": item_data["item_code"],
-            "qty": item_data["qty"],
-            "uom": item_data["uom"],
-            "stock_uom": item_data["stock_uom"],
-            "conversion_factor": item_data["conversion_factor"],
-            "basic_rate": item_data["basic_rate"],
-        }
-        for item_data in consolidated_items.values()
-    ]
+    # Verrou sur le transfert : le job en arrière-plan termine son lot en cours, puis s'arrête (annulé)
+    lock_transfert(doc.name)
+    items = get_transferred_items(doc.name)
+    if not items:
+        frappe.msgprint("Aucun stock n'a encore été transféré : aucun retour nécessaire.")
+        return
 
-    stock_entry.insert()
-    stock_entry.submit()
+    # Dépôt cible devient source, retour au dépôt d'origine
+    stock_entry = make_stock_entry(
+        items,
+        from_warehouse=doc.to_warehouse,
+        to_warehouse=doc.from_warehouse,
+    )
 
     frappe.msgprint(f"Retour des articles effectué avec succès : {stock_entry.name}")
 
@@ -126,32 +150,244 @@ def auto_transfer_stock(transfert_name):
     if not transfert.delivery_notes:
         frappe.throw("Aucun bon de livraison à transférer.")
 
-    consolidated_items = {}
+    delivery_notes = [row.delivery_note for row in transfert.delivery_notes]
+    check_delivery_notes_ready(delivery_notes)
+
+    # Verrou sur le transfert : sérialise avec le job en arrière-plan, qui le prend avant chaque lot
+    lock_transfert(transfert.name)
+    if is_job_enqueued(get_transfer_job_id(transfert.name)):
+        frappe.throw("Un transfert de stock est déjà en cours en arrière-plan pour ce transfert.")
+
+    existing = get_transfer_stock_entries(transfert.name)
+    if existing:
+        frappe.throw(f"Le stock de ce transfert a déjà été transféré : {', '.join(existing)}")
+
+    stock_entry = make_stock_entry(
+        get_consolidated_items(delivery_notes),
+        from_warehouse=transfert.from_warehouse,
+        to_warehouse=transfert.to_warehouse,
+        transfert_name=transfert.name,
+    )
+
+    frappe.msgprint(f"Transfert de stock créé avec succès : {stock_entry.name}")
+    return stock_entry.name
+
+
+@frappe.whitelist()
+def enqueue_transfer_stock(transfert_name, chunk_size=None):
+    """Lance le transfert de stock du transfert en arrière-plan.
+
+    Les contrôles sont faits tout de suite pour que l'utilisateur voie les
+    erreurs ; la création des Stock Entry est confiée à un job unique par
+    transfert, qui publie son avancement sur le formulaire.
+    """
+    transfert = frappe.get_doc("Transferts Marchandise", transfert_name)
+    transfert.check_permission("write")
+
+    if transfert.docstatus != 1:
+        frappe.throw("Le transfert doit être soumis avant de générer un transfert de stock.")
+
+    if not transfert.delivery_notes:
+        frappe.throw("Aucun bon de livraison à transférer.")
+
+    check_delivery_notes_ready([row.delivery_note for row in transfert.delivery_notes])
+
+    frappe.enqueue(
+        "log.log.doctype.transferts_marchandise.transferts_marchandise.run_transfer_stock",
+        queue="long",
+        job_id=get_transfer_job_id(transfert.name),
+        deduplicate=True,
+        enqueue_after_commit=True,
+        transfert_name=transfert.name,
+        chunk_size=get_transfer_chunk_size(chunk_size),
+    )
 
-    for row in transfert.delivery_notes:
-        delivery_note = frappe.get_doc("Delivery Note", row.delivery_note)
+    return {"success": True, "message": "Transfert de stock lancé en arrière-plan."}
 
-        if delivery_note.status != "To Deliver":
-            frappe.throw(f"Le bon de livraison {row.delivery_note} n'est pas prêt pour le transfert.")
 
-        for item in delivery_note.items:
-            item_key = (item.item_code, item.uom)
-            if item_key in consolidated_items:
-                consolidated_items[item_key]["qty"] += item.qty
-            else:
-                consolidated_items[item_key] = {
-                    "item_code": item.item_code,
-                    "qty": item.qty,
-                    "uom": item.uom,
-                    "stock_uom": item.stock_uom,
-                    "conversion_factor": item.conversion_factor,
-                    "basic_rate": item.rate,
-                }
+def run_transfer_stock(transfert_name, chunk_size):
+    """Job : crée les Stock Entry du transfert, lot par lot.
 
+    Chaque Stock Entry est lié au transfert (`custom_transfert_marchandise`)
+    et validé (commit) dès sa soumission. Seules les quantités non encore
+    couvertes par les Stock Entry liés sont transférées : une relance, quelle
+    que soit la taille des lots, reprend là où le job précédent s'est arrêté.
+    Le transfert est verrouillé et son statut relu avant chaque lot ; une
+    annulation arrête le job.
+    """
+    transfert = frappe.get_doc("Transferts Marchandise", transfert_name)
+    stock_entries = []
+    chunks = []
+
+    try:
+        if not lock_transfert(transfert.name):
+            publish_transfer_progress(
+                transfert.name, 0, 0, [], error="Le transfert n'est plus soumis, transfert de stock abandonné."
+            )
+            return []
+
+        stock_entries = get_transfer_stock_entries(transfert.name)
+        chunks = split_into_chunks(get_remaining_items(transfert), chunk_size)
+        total = len(stock_entries) + len(chunks)
+        if not chunks:
+            # Tout est déjà transféré : signaler la fin au formulaire
+            publish_transfer_progress(transfert.name, total, total, stock_entries)
+
+        for items in chunks:
+            if not lock_transfert(transfert.name):
+                publish_transfer_progress(
+                    transfert.name, len(stock_entries), total, stock_entries,
+                    error="Le transfert a été annulé, transfert de stock interrompu.",
+                )
+                return stock_entries
+
+            stock_entries.append(make_stock_entry(
+                items,
+                from_warehouse=transfert.from_warehouse,
+                to_warehouse=transfert.to_warehouse,
+                transfert_name=transfert.name,
+            ).name)
+            frappe.db.commit()
+
+            publish_transfer_progress(transfert.name, len(stock_entries), total, stock_entries)
+
+    except Exception:
+        frappe.db.rollback()
+        publish_transfer_progress(
+            transfert.name, len(stock_entries), len(stock_entries) + len(chunks), stock_entries,
+            error="Erreur lors du transfert de stock, relancez le transfert pour reprendre.",
+        )
+        frappe.log_error(f"Transfert de stock {transfert.name}", frappe.get_traceback())
+        raise
+
+    return stock_entries
+
+
+def lock_transfert(transfert_name):
+    """Verrouille le transfert jusqu'à la fin de la transaction et indique s'il est toujours soumis."""
+    return frappe.db.get_value("Transferts Marchandise", transfert_name, "docstatus", for_update=True) == 1
+
+
+def get_transfer_job_id(transfert_name):
+    return f"log::stock_transfer::{transfert_name}"
+
+
+def get_transfer_stock_entries(transfert_name):
+    """Stock Entry soumis liés au transfert."""
+    return frappe.get_all(
+        "Stock Entry",
+        filters={"custom_transfert_marchandise": transfert_name, "docstatus": 1},
+        pluck="name",
+        order_by="creation asc",
+    )
+
+
+def get_transferred_items(transfert_name):
+    """Lignes déplacées par les Stock Entry soumis du transfert, consolidées par (item_code, uom)."""
+    return frappe.db.sql("""
+        SELECT
+            sed.item_code,
+            sed.uom,
+            SUM(sed.qty) AS qty,
+            MAX(sed.stock_uom) AS stock_uom,
+            MAX(sed.conversion_factor) AS conversion_factor,
+            COALESCE(SUM(sed.basic_rate * sed.qty) / NULLIF(SUM(sed.qty), 0), 0) AS basic_rate
+        FROM `tabStock Entry Detail` sed
+        INNER JOIN `tabStock Entry` se ON se.name = sed.parent
+        WHERE se.custom_transfert_marchandise = %s AND se.docstatus = 1
+        GROUP BY sed.item_code, sed.uom
+        HAVING SUM(sed.qty) > 0
+        ORDER BY MIN(sed.idx), sed.item_code
+    """, (transfert_name,), as_dict=True)
+
+
+def get_remaining_items(transfert):
+    """Lignes consolidées du transfert, diminuées des quantités déjà transférées par ses Stock Entry."""
+    transferred = {(row.item_code, row.uom): row.qty for row in get_transferred_items(transfert.name)}
+
+    remaining = []
+    for item in get_consolidated_items([row.delivery_note for row in transfert.delivery_notes]):
+        qty = flt(item.qty) - flt(transferred.get((item.item_code, item.uom)))
+        if qty > 0:
+            remaining.append({**item, "qty": qty})
+    return remaining
+
+
+def check_delivery_notes_ready(delivery_notes):
+    """Vérifie en une requête que tous les bons de livraison sont prêts pour le transfert."""
+    not_ready = frappe.get_all(
+        "Delivery Note",
+        filters={"name": ["in", delivery_notes], "status": ["!=", "To Deliver"]},
+        pluck="name",
+        order_by="name asc",
+    )
+    if not_ready:
+        frappe.throw(
+            "<br>".join(f"Le bon de livraison {name} n'est pas prêt pour le transfert." for name in not_ready)
+        )
+
+
+def get_transfer_chunk_size(chunk_size=None):
+    """Taille des lots : valeur demandée, sinon configuration du site, sinon valeur par défaut."""
+    return cint(chunk_size) or cint(frappe.conf.get("log_stock_transfer_chunk_size")) or DEFAULT_TRANSFER_CHUNK_SIZE
+
+
+def split_into_chunks(items, chunk_size):
+    """Découpe les lignes consolidées en lots d'au plus `chunk_size` lignes."""
+    chunk_size = max(cint(chunk_size), 1)
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def publish_transfer_progress(transfert_name, done, total, stock_entries, error=None):
+    """Publie l'avancement du transfert sur le formulaire du Transferts Marchandise."""
+    frappe.publish_realtime(
+        "stock_transfer_progress",
+        {
+            "transfert": transfert_name,
+            "done": done,
+            "total": total,
+            "stock_entries": stock_entries,
+            "error": error,
+        },
+        doctype="Transferts Marchandise",
+        docname=transfert_name,
+    )
+
+
+def get_consolidated_items(delivery_notes):
+    """Consolide les articles des bons de livraison par (item_code, uom).
+
+    Une seule requête groupée sur `tabDelivery Note Item`, sans charger les
+    documents. Le taux retenu est la moyenne des taux pondérée par les quantités.
+    """
+    if not delivery_notes:
+        return []
+
+    return frappe.db.sql("""
+        SELECT
+            item_code,
+            uom,
+            SUM(qty) AS qty,
+            MAX(stock_uom) AS stock_uom,
+            MAX(conversion_factor) AS conversion_factor,
+            COALESCE(SUM(rate * qty) / NULLIF(SUM(qty), 0), 0) AS basic_rate
+        FROM `tabDelivery Note Item`
+        WHERE parent IN %s AND parenttype = 'Delivery Note'
+        GROUP BY item_code, uom
+        ORDER BY MIN(idx), item_code
+    """, (tuple(delivery_notes),), as_dict=True)
+
+
+def make_stock_entry(items, from_warehouse, to_warehouse, transfert_name=None):
+    """Crée et soumet un Stock Entry de transfert pour les articles consolidés.
+
+    `transfert_name` lie le Stock Entry au transfert dont il déplace le stock.
+    """
     stock_entry = frappe.new_doc("Stock Entry")
     stock_entry.purpose = "Material Transfer"
-    stock_entry.from_warehouse = transfert.from_warehouse
-    stock_entry.to_warehouse = transfert.to_warehouse
+    stock_entry.from_warehouse = from_warehouse
+    stock_entry.to_warehouse = to_warehouse
+    stock_entry.custom_transfert_marchandise = transfert_name
     stock_entry.items = [
         {
             "item_code": item_data["item_code"],
@@ -161,11 +397,9 @@ def auto_transfer_stock(transfert_name):
             "conversion_factor": item_data["conversion_factor"],
             "basic_rate": item_data["basic_rate"],
         }
-        for item_data in consolidated_items.values()
+        for item_data in items
     ]
 
     stock_entry.insert()
     stock_entry.submit()
-
-    frappe.msgprint(f"Transfert de stock créé avec succès : {stock_entry.name}")
-    return stock_entry.name
+    return stock_entry
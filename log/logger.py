@@ -0,0 +1,67 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""Journalisation structurée de l'application.
+
+Les événements sont écrits sur une ligne JSON dans le journal fichier du
+site (logs/log.<module>.log), ou sur la sortie standard si `log_app_stdout`
+est activé dans site_config.json. Aucun n'est écrit en base : seules les
+vraies erreurs passent par `error()`, qui crée aussi un Error Log.
+
+Les traces de débogage sont désactivées par défaut ; `log_app_debug` les
+active pour une liste de modules, ou pour tous avec "*" :
+
+	"log_app_debug": ["sequences", "delivery_note_sync"]
+"""
+
+import json
+import logging
+import random
+
+import frappe
+
+
+def get_logger(module):
+	logger = frappe.logger(
+		f"log.{module}", allow_site=True, stream_only=bool(frappe.conf.get("log_app_stdout"))
+	)
+	logger.setLevel(logging.DEBUG if is_debug_enabled(module) else logging.INFO)
+	return logger
+
+
+def is_debug_enabled(module):
+	"""Vrai si les traces de débogage sont activées pour ce module"""
+	enabled = frappe.conf.get("log_app_debug")
+	if not enabled:
+		return False
+	if enabled in ("*", True, 1):
+		return True
+	return module in enabled
+
+
+def debug(module, event, sample_rate=1.0, **fields):
+	"""Trace de débogage, ignorée sauf si le module est activé ; `sample_rate` < 1 n'en garde qu'une partie"""
+	if not is_debug_enabled(module):
+		return
+	if sample_rate < 1 and random.random() >= sample_rate:
+		return
+	get_logger(module).debug(_format(event, fields))
+
+
+def info(module, event, **fields):
+	get_logger(module).info(_format(event, fields))
+
+
+def warning(module, event, **fields):
+	get_logger(module).warning(_format(event, fields))
+
+
+def error(module, event, title=None, **fields):
+	"""Erreur réelle : journalisée et enregistrée dans Error Log"""
+	message = _format(event, fields)
+	get_logger(module).error(message)
+	frappe.log_error(title=title or event, message=message)
+
+
+def _format(event, fields):
+	return json.dumps({"event": event, **fields}, default=str, ensure_ascii=False)
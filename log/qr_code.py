@@ -0,0 +1,160 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+"""QR codes des colis, adressés par leur contenu.
+
+Le nom du fichier joint contient une empreinte du contenu encodé :
+tant que ce contenu ne change pas, la pièce jointe existante est
+réutilisée et aucune image n'est générée.
+"""
+
+import hashlib
+import io
+
+import frappe
+import qrcode
+
+QR_FILE_PREFIX = "qr_code_"
+
+
+def get_colis_qr_data(colis_name):
+	"""Retourne le contenu encodé dans le QR code d'un colis (URL de l'interface livreurs)"""
+	return f"{frappe.utils.get_url()}/frontend/colis/{colis_name}"
+
+
+def get_qr_digest(data):
+	"""Empreinte courte du contenu encodé"""
+	return hashlib.sha1(data.encode("utf-8")).hexdigest()[:12]
+
+
+def get_qr_file_name(colis_name, digest):
+	return f"{QR_FILE_PREFIX}{colis_name}_{digest}.png"
+
+
+def render_qr_png(data):
+	"""Génère l'image PNG d'un QR code
+
+	Args:
+		data (str): Le contenu à encoder
+
+	Returns:
+		bytes: Le contenu PNG
+	"""
+	qr = qrcode.QRCode(
+		version=4,
+		error_correction=qrcode.constants.ERROR_CORRECT_M,
+		box_size=6,
+		border=2,
+	)
+	qr.add_data(data)
+	qr.make(fit=True)
+
+	img = qr.make_image(fill_color="black", back_color="white")
+
+	buffer = io.BytesIO()
+	img.save(buffer, format="PNG", optimize=True)
+	return buffer.getvalue()
+
+
+def is_qr_code_current(doc, data=None):
+	"""Vrai si le champ image du colis pointe déjà vers le QR code du contenu actuel"""
+	if not doc.image:
+		return False
+	digest = get_qr_digest(data or get_colis_qr_data(doc.name))
+	return doc.image.endswith(get_qr_file_name(doc.name, digest))
+
+
+def ensure_qr_code(doc, now=False):
+	"""Garantit que le colis possède le QR code de son contenu actuel.
+
+	Ne fait rien si l'image est déjà à jour. Sinon, la génération est
+	confiée à un job en arrière-plan exécuté après le commit, sauf si
+	`now` est vrai. Le contenu est calculé ici, dans la requête, et transmis
+	au job : un worker n'a pas d'hôte de requête et `get_url()` y donnerait
+	une autre URL, donc une empreinte qui ne correspondrait jamais.
+	"""
+	if not doc.name or doc.name == "new-colis":
+		return
+
+	data = get_colis_qr_data(doc.name)
+	if is_qr_code_current(doc, data):
+		return
+
+	if now:
+		doc.image = attach_qr_code(doc.name, data)
+		return
+
+	frappe.enqueue(
+		"log.qr_code.update_colis_qr_code",
+		queue="short",
+		job_id=f"log::colis_qr::{doc.name}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		colis_name=doc.name,
+		data=data,
+	)
+
+
+def update_colis_qr_code(colis_name, data=None):
+	"""Job : génère (si nécessaire) le QR code d'un colis et met à jour son champ image
+
+	Args:
+		colis_name (str): Le nom du document Colis
+		data (str): Le contenu calculé lors de la mise en file
+	"""
+	if not frappe.db.exists("Colis", colis_name):
+		return
+
+	file_url = attach_qr_code(colis_name, data)
+	frappe.db.set_value("Colis", colis_name, "image", file_url, update_modified=False)
+
+
+def attach_qr_code(colis_name, data=None):
+	"""Retourne l'URL de la pièce jointe QR code du colis, en la créant si le contenu a changé
+
+	Args:
+		colis_name (str): Le nom du document Colis
+		data (str): Le contenu à encoder (par défaut, l'URL du colis)
+
+	Returns:
+		str: L'URL du fichier QR code
+	"""
+	data = data or get_colis_qr_data(colis_name)
+	file_name = get_qr_file_name(colis_name, get_qr_digest(data))
+
+	existing_files = frappe.get_all(
+		"File",
+		filters={
+			"attached_to_doctype": "Colis",
+			"attached_to_name": colis_name,
+			"file_name": ["like", f"{QR_FILE_PREFIX}%"],
+		},
+		fields=["name", "file_name", "file_url"],
+	)
+
+	file_url = None
+	for file in existing_files:
+		if file.file_name == file_name and not file_url:
+			file_url = file.file_url
+			continue
+
+		# Ancien contenu (ou doublon) : supprimer la pièce jointe obsolète
+		try:
+			frappe.delete_doc("File", file.name, ignore_permissions=True)
+		except Exception as e:
+			frappe.log_error(f"Erreur lors de la suppression du fichier QR code: {e}")
+
+	if file_url:
+		return file_url
+
+	file_doc = frappe.get_doc(
+		{
+			"doctype": "File",
+			"file_name": file_name,
+			"attached_to_doctype": "Colis",
+			"attached_to_name": colis_name,
+			"content": render_qr_png(data),
+			"is_private": 0,
+		}
+	)
+	return file_doc.insert(ignore_permissions=True).file_url
@@ -0,0 +1,115 @@
+# Copyright (c) 2025, IntraPro and contributors
+# For license information, please see license.txt
+
+import frappe
+
+from log import logger
+
+INVALIDATION_STATS_KEY = "log:cache_invalidations"
+LOCK_WAIT_STATS_KEY = "log:lock_waits"
+SLOW_LOCK_WAIT_MS = 500
+
+# Durée de vie maximale du marqueur « job en attente » (sécurité si un worker meurt)
+PENDING_JOB_TTL = 10 * 60
+
+
+def enqueue_coalesced(method, key, queue="short", **kwargs):
+	"""Met en file `method` une seule fois par clé tant que le job n'a pas démarré.
+
+	La mise en file a lieu après le commit de la transaction courante. Les
+	appels suivants avec la même clé sont ignorés jusqu'à ce que le job
+	appelle `release_coalesced(key)` ; une rafale de modifications ne produit
+	donc qu'une exécution, qui lit l'état le plus récent.
+	"""
+	pending = frappe.flags.setdefault("log_coalesced_jobs", set())
+	if key in pending:
+		return
+	pending.add(key)
+
+	def _enqueue():
+		pending.discard(key)
+		if frappe.cache.set(_pending_key(key), 1, nx=True, ex=PENDING_JOB_TTL):
+			frappe.enqueue(method, queue=queue, **kwargs)
+
+	frappe.db.after_commit.add(_enqueue)
+
+
+def release_coalesced(key):
+	"""À appeler au début du job : les modifications suivantes remettront un job en file"""
+	frappe.cache.delete(_pending_key(key))
+
+
+def _pending_key(key):
+	return frappe.cache.make_key(f"log:pending_job:{key}")
+
+
+def invalidate_documents(doctype, names):
+	"""Invalide le cache des seuls documents concernés (au lieu de tout le doctype)"""
+	if isinstance(names, str):
+		names = [names]
+	names = [name for name in names if name]
+	if not names:
+		return
+
+	for name in names:
+		frappe.clear_document_cache(doctype, name)
+	record_invalidation(doctype, len(names))
+
+
+def record_invalidation(scope, count=1):
+	"""Compte les invalidations de cache faites par l'application, par périmètre"""
+	frappe.cache.execute_command("HINCRBY", frappe.cache.make_key(INVALIDATION_STATS_KEY), scope, count)
+	logger.debug("cache", "invalidate", sample_rate=0.1, scope=scope, count=count)
+
+
+def record_lock_wait(scope, wait_ms):
+	"""Enregistre le temps d'attente d'un verrou (nombre, cumul, attentes longues)"""
+	key = frappe.cache.make_key(LOCK_WAIT_STATS_KEY)
+	frappe.cache.execute_command("HINCRBY", key, f"{scope}:count", 1)
+	frappe.cache.execute_command("HINCRBYFLOAT", key, f"{scope}:total_ms", round(wait_ms, 3))
+	if wait_ms >= SLOW_LOCK_WAIT_MS:
+		frappe.cache.execute_command("HINCRBY", key, f"{scope}:slow", 1)
+		logger.warning("locks", "slow_lock_wait", scope=scope, wait_ms=round(wait_ms, 1))
+
+
+@frappe.whitelist()
+def get_invalidation_stats():
+	"""Retourne le nombre d'invalidations de cache par périmètre depuis la dernière remise à zéro"""
+	frappe.only_for("System Manager")
+	return {scope: int(count) for scope, count in _get_stats(INVALIDATION_STATS_KEY).items()}
+
+
+@frappe.whitelist()
+def get_lock_wait_stats():
+	"""Retourne, par verrou, le nombre d'acquisitions, l'attente cumulée et moyenne (ms) et les attentes longues"""
+	frappe.only_for("System Manager")
+
+	stats = {}
+	for field, value in _get_stats(LOCK_WAIT_STATS_KEY).items():
+		scope, metric = field.rsplit(":", 1)
+		stats.setdefault(scope, {"count": 0, "total_ms": 0.0, "slow": 0})[metric] = float(value)
+
+	for scope_stats in stats.values():
+		scope_stats["avg_ms"] = scope_stats["total_ms"] / scope_stats["count"] if scope_stats["count"] else 0
+	return stats
+
+
+@frappe.whitelist(methods=["POST"])
+def reset_invalidation_stats():
+	"""Remet à zéro les compteurs d'invalidation de cache"""
+	frappe.only_for("System Manager")
+	frappe.cache.delete(frappe.cache.make_key(INVALIDATION_STATS_KEY))
+
+
+@frappe.whitelist(methods=["POST"])
+def reset_stats():
+	"""Remet à zéro les compteurs d'invalidation de cache et les statistiques d'attente de verrous"""
+	frappe.only_for("System Manager")
+	frappe.cache.delete(
+		frappe.cache.make_key(INVALIDATION_STATS_KEY), frappe.cache.make_key(LOCK_WAIT_STATS_KEY)
+	)
+
+
+def _get_stats(key):
+	stats = frappe.cache.execute_command("HGETALL", frappe.cache.make_key(key)) or {}
+	return {frappe.safe_decode(field): frappe.safe_decode(value) for field, value in stats.items()}
@@ -1,34 +1,158 @@
 import frappe
 
+import hashlib
 import json
-import re
+import os
+
+from werkzeug.wrappers import Response
 
 no_cache = 1
 
-SCRIPT_TAG_PATTERN = re.compile(r"\<script[^<]*\</script\>")
-CLOSING_SCRIPT_TAG_PATTERN = re.compile(r"</script\>")
+# Boot allégé de l'application livreurs, mis en cache par utilisateur et session
+BOOT_CACHE_KEY = "log:colis_boot"
+BOOT_CACHE_TTL = 60 * 60
+
+# Manifeste Vite du build (build.manifest) et URL publique des fichiers du bundle
+ASSETS_URL = "/assets/log/Colis/"
+MANIFEST_ENTRY = "index.html"
+_manifest_cache = {}
+
 
 def get_context(context):
-    csrf_token = frappe.sessions.get_csrf_token()
-    frappe.db.commit()
+    csrf_token = get_csrf_token()
     context.csrf_token = csrf_token
 
-    if frappe.session.user == "Guest":
-        boot = frappe.website.utils.get_boot_data()
+    # `log_colis_full_boot` dans site_config.json rétablit le boot complet du bureau
+    if frappe.conf.get("log_colis_full_boot"):
+        boot = get_full_boot()
     else:
-        try:
-            boot = frappe.sessions.get()
-        except Exception as e:
-            raise frappe.SessionBootFailed from e
-    boot_json = frappe.as_json(boot, indent=None, separators=(",", ":"))
-    boot_json = SCRIPT_TAG_PATTERN.sub("", boot_json)
-
-    boot_json = CLOSING_SCRIPT_TAG_PATTERN.sub("", boot_json)
-    boot_json = json.dumps(boot_json)
+        boot = get_colis_boot(csrf_token)["boot"]
 
     context.update({
         "build_version": frappe.utils.get_build_version(),
-        "boot": boot_json,
+        "boot": boot_to_script(boot),
+        "preload_assets": get_preload_assets(),
     })
 
-    return context
\ No newline at end of file
+    return context
+
+
+@frappe.whitelist(allow_guest=True, methods=["GET"])
+def get_boot():
+    """Boot allégé avec ETag : une requête conditionnelle à jour reçoit un 304 sans contenu."""
+    cached = get_colis_boot(get_csrf_token())
+
+    response = Response()
+    response.headers["ETag"] = f'"{cached["etag"]}"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.headers["Vary"] = "Cookie"
+
+    if cached["etag"] in frappe.request.if_none_match:
+        response.status_code = 304
+        return response
+
+    response.mimetype = "application/json"
+    response.set_data(frappe.as_json(cached["boot"], indent=None, separators=(",", ":")))
+    return response
+
+
+def get_csrf_token():
+    """Retourne le jeton CSRF de la session ; ne commite que si un nouveau jeton a été généré."""
+    generated = not frappe.local.session.data.csrf_token
+    csrf_token = frappe.sessions.get_csrf_token()
+    if generated:
+        frappe.db.commit()
+    return csrf_token
+
+
+def get_colis_boot(csrf_token):
+    """Retourne le boot allégé et son empreinte, depuis le cache si possible
+
+    Le boot d'un visiteur (Guest) n'est pas mis en cache : la session Guest est
+    commune à tous les visiteurs et son jeton CSRF change à chaque requête.
+
+    Returns:
+        dict: `boot` (utilisateur, jeton CSRF, site, versions) et `etag`
+    """
+    user = frappe.session.user
+    key = f"{BOOT_CACHE_KEY}:{user}:{frappe.session.sid}"
+    if user != "Guest":
+        cached = frappe.cache.get_value(key)
+        if cached and cached["boot"]["csrf_token"] == csrf_token:
+            return cached
+
+    boot = {
+        "user": {
+            "name": user,
+            "full_name": frappe.utils.get_fullname(user),
+            "roles": frappe.get_roles(user) if user != "Guest" else ["Guest"],
+        },
+        "csrf_token": csrf_token,
+        "sitename": frappe.local.site,
+        "lang": frappe.local.lang,
+        "time_zone": frappe.utils.get_system_timezone(),
+        "versions": {"frappe": frappe.__version__},
+    }
+    cached = {
+        "boot": boot,
+        "etag": hashlib.sha1(frappe.as_json(boot).encode("utf-8")).hexdigest(),
+    }
+    if user != "Guest":
+        frappe.cache.set_value(key, cached, expires_in_sec=BOOT_CACHE_TTL)
+    return cached
+
+
+def get_full_boot():
+    if frappe.session.user == "Guest":
+        return frappe.website.utils.get_boot_data()
+
+    try:
+        return frappe.sessions.get()
+    except Exception as e:
+        raise frappe.SessionBootFailed from e
+
+
+def boot_to_script(boot):
+    # JSON littéral directement utilisable dans <script> : échapper "<" évite
+    # toute fermeture de balise sans retoucher ni réencoder le contenu
+    return frappe.as_json(boot, indent=None, separators=(",", ":")).replace("<", "\\u003c")
+
+
+def get_preload_assets():
+    """Fichiers du point d'entrée à précharger, d'après le manifeste Vite (relu si le build change)
+
+    Returns:
+        list: Dicts `href` / `rel` / `as` pour les balises <link> de préchargement
+    """
+    path = frappe.get_app_path("log", "public", "Colis", ".vite", "manifest.json")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return []
+
+    if _manifest_cache.get("mtime") != mtime:
+        with open(path) as f:
+            manifest = json.load(f)
+        _manifest_cache.update(mtime=mtime, assets=_collect_preload_assets(manifest))
+
+    return _manifest_cache["assets"]
+
+
+def _collect_preload_assets(manifest):
+    assets = []
+    seen = set()
+
+    def visit(key):
+        chunk = manifest.get(key)
+        if not chunk or key in seen:
+            return
+        seen.add(key)
+
+        assets.append({"href": ASSETS_URL + chunk["file"], "rel": "modulepreload", "as": "script"})
+        for css in chunk.get("css", []):
+            assets.append({"href": ASSETS_URL + css, "rel": "preload", "as": "style"})
+        for imported in chunk.get("imports", []):
+            visit(imported)
+
+    visit(MANIFEST_ENTRY)
+    return assets